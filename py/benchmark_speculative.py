@@ -0,0 +1,113 @@
+"""
+Benchmark of speculative multi-move generation.
+Plays the same rollouts with plain predict(stop_at_next_move=False) and with a
+small draft model proposing plies that the main model verifies in one forward,
+then prints tokens per second for both, the speedup and the draft acceptance rate.
+"""
+
+import time
+import argparse
+import torch
+
+from chessutils.configuration import get_configuration
+from chessutils.model import build_model, load_checkpoint
+from chessutils.tokenizer import Tokenizer
+
+
+def _parse_args():
+    """
+    Parse command-line arguments for the main and draft models and the rollouts.
+    """
+    parser = argparse.ArgumentParser(description='CheckMate speculative generation benchmark')
+
+    parser.add_argument('--load_model', type=str, default="model/checkmate.pth",
+                        help='Path to the main model')
+    parser.add_argument('--config', type=str, default="configs/default.yaml",
+                        help='Configuration file (YAML format) of the main model')
+    parser.add_argument('--draft_model', type=str, required=True,
+                        help='Path to the draft model (e.g. a distilled student)')
+    parser.add_argument('--draft_config', type=str, default="configs/small.yaml",
+                        help='Configuration file (YAML format) of the draft model')
+    parser.add_argument('--tokenizer', type=str, default="vocab/vocab.txt",
+                        help='Path to the tokenizer vocabulary file')
+    parser.add_argument('--rollouts', type=int, default=20,
+                        help='Number of rollouts per mode')
+    parser.add_argument('--max_length', type=int, default=80,
+                        help='Length of every rollout in tokens')
+    parser.add_argument('--num_draft', type=int, default=4,
+                        help='Plies proposed by the draft model per verification')
+    parser.add_argument('--temperature', type=float, default=0.5,
+                        help='Sampling temperature')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed (both modes replay the same seeds)')
+
+    return parser.parse_args()
+
+
+def _load(checkpoint_path, config_path, tokenizer):
+    model = build_model(get_configuration(config_path), tokenizer)
+    model.load_state_dict(load_checkpoint(checkpoint_path, map_location="cpu"))
+    model.eval()
+    return model
+
+
+def run_rollouts(model, args, draft_model=None) -> dict:
+    """
+    Plays args.rollouts rollouts from the initial position and returns the
+    generated tokens, the seconds spent and the speculative statistics.
+    """
+    tokens, seconds = 0, 0.0
+    stats = {"forwards": 0, "drafted": 0, "accepted": 0}
+
+    with torch.no_grad():
+        for i in range(args.rollouts):
+            torch.manual_seed(args.seed + i)
+
+            start = time.perf_counter()
+            output = model.predict(
+                "<bos>",
+                max_length=args.max_length,
+                temperature=args.temperature,
+                draft_model=draft_model,
+                num_draft=args.num_draft,
+            )
+            seconds += time.perf_counter() - start
+            tokens += len(output.split(" ")) - 1
+
+            if draft_model is not None:
+                for key in stats:
+                    stats[key] += model.speculative_stats[key]
+
+    return {"tokens": tokens, "seconds": seconds, **stats}
+
+
+def main(args) -> None:
+    """
+    Loads both models, runs the rollouts in both modes and prints the comparison.
+    """
+    tokenizer = Tokenizer(args.tokenizer)
+    model = _load(args.load_model, args.config, tokenizer)
+    draft_model = _load(args.draft_model, args.draft_config, tokenizer)
+
+    # Warm up both paths once
+    run_rollouts(model, argparse.Namespace(**{**vars(args), "rollouts": 1}))
+    run_rollouts(model, argparse.Namespace(**{**vars(args), "rollouts": 1}), draft_model)
+
+    plain = run_rollouts(model, args)
+    speculative = run_rollouts(model, args, draft_model)
+
+    plain_rate = plain["tokens"] / plain["seconds"] if plain["seconds"] else 0.0
+    speculative_rate = speculative["tokens"] / speculative["seconds"] if speculative["seconds"] else 0.0
+    acceptance = speculative["accepted"] / speculative["drafted"] if speculative["drafted"] else 0.0
+
+    print("\n -------- SPECULATIVE GENERATION REPORT --------\n")
+    print("mode\ttokens\ttokens_per_sec\tforwards")
+    print(f"plain\t{plain['tokens']}\t{plain_rate:.1f}\t{plain['tokens']}")
+    print(f"speculative\t{speculative['tokens']}\t{speculative_rate:.1f}\t{speculative['forwards']}")
+    print(f"\nSpeedup: {speculative_rate / plain_rate if plain_rate else 0.0:.2f}x")
+    print(f"Acceptance rate: {acceptance:.3f} ({speculative['accepted']}/{speculative['drafted']} drafted plies)")
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    main(args)
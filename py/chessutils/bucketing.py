@@ -0,0 +1,117 @@
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from chessutils.model import Transformer
+
+
+BUCKETING_MODES = ("eager", "trace", "compile")
+
+
+def default_buckets(n_positions: int, step: int = 16) -> list:
+    buckets = list(range(step, n_positions, step))
+    return buckets + [n_positions]
+
+
+class _BucketGraph(nn.Module):
+    # Forward pass for one fixed sequence length, with its causal mask baked in
+    def __init__(self, model: Transformer, length: int):
+        super().__init__()
+        self.model = model
+        device = next(model.parameters()).device
+        self.register_buffer("src_mask", model.get_src_mask(length).bool().to(device))
+
+    def forward(self, input_ids: torch.Tensor, last_index: torch.Tensor) -> torch.Tensor:
+        # Right padding needs no padding mask: the causal mask already hides it from real tokens
+        hidden = self.model.encode(input_ids, self.src_mask)
+
+        # Only the last real position is projected; an index tensor keeps it dynamic in traced graphs
+        hidden = hidden.index_select(0, last_index)
+        return F.log_softmax(self.model.out(hidden), dim=-1)
+
+
+class BucketedForward:
+    """
+    Runs the model on inputs right-padded to a few fixed lengths (buckets), so a
+    traced or compiled graph only ever sees one shape per bucket and never
+    recompiles. warmup() builds and runs every bucket ahead of the first request.
+    """
+
+    def __init__(self, model: Transformer, buckets: list = None, mode: str = "trace"):
+        assert mode in BUCKETING_MODES, f"Unknown bucketing mode: {mode}"
+
+        self.model = model
+        self.mode = mode
+        self.buckets = sorted(buckets or default_buckets(model.n_positions))
+        assert self.buckets[-1] >= model.n_positions, "The largest bucket must cover n_positions"
+
+        self.graphs = {}
+        self.warmup_seconds = {}
+
+    def bucket_for(self, length: int) -> int:
+        for bucket in self.buckets:
+            if bucket >= length:
+                return bucket
+        raise ValueError(f"Sequence of length {length} exceeds the largest bucket")
+
+    def _example(self, length: int) -> tuple:
+        device = next(self.model.parameters()).device
+        example = torch.full((length, 1), self.model.tokenizer.pad_token_index, dtype=torch.long, device=device)
+        example[0] = self.model.tokenizer.bos_token_index
+        return example, torch.zeros(1, dtype=torch.long, device=device)
+
+    def _build(self, length: int):
+        graph = _BucketGraph(self.model, length).eval()
+
+        if self.mode == "trace":
+            try:
+                with torch.no_grad():
+                    return torch.jit.trace(graph, self._example(length), check_trace=False)
+            except Exception as e:
+                print(f"Tracing bucket {length} failed, running it eagerly: {e}")
+        elif self.mode == "compile":
+            if hasattr(torch, "compile"):
+                return torch.compile(graph, dynamic=False)
+            print("torch.compile is not available, running buckets eagerly.")
+
+        return graph
+
+    def warmup(self, runs: int = 3) -> dict:
+        """
+        Builds the graph of every bucket and runs it a few times (JIT executors
+        and torch.compile specialize on the first calls). Returns the seconds
+        spent per bucket.
+        """
+        self.model.eval()
+
+        with torch.no_grad():
+            for bucket in self.buckets:
+                start = time.perf_counter()
+                graph = self._build(bucket)
+                example = self._example(bucket)
+                for _ in range(runs):
+                    graph(*example)
+                self.graphs[bucket] = graph
+                self.warmup_seconds[bucket] = time.perf_counter() - start
+
+        return self.warmup_seconds
+
+    def __call__(self, input_ids: torch.Tensor) -> torch.Tensor:
+        """
+        Returns the log-probs of the token following `input_ids` (sequence length, 1).
+        """
+        length = input_ids.size(0)
+        bucket = self.bucket_for(length)
+        graph = self.graphs.get(bucket)
+        if graph is None:
+            graph = self.graphs[bucket] = self._build(bucket)
+
+        device = next(self.model.parameters()).device
+        padded = torch.full((bucket, 1), self.model.tokenizer.pad_token_index, dtype=torch.long, device=device)
+        padded[:length] = input_ids.to(device)
+
+        last_index = torch.tensor([length - 1], dtype=torch.long, device=device)
+        pred = graph(padded, last_index)
+        return pred[0, 0].to(input_ids.device)
@@ -1,4 +1,8 @@
 import os
+import json
+import random
+import hashlib
+import numpy as np
 import torch
 from pathlib import Path
 from torch.utils.data import Dataset
@@ -9,9 +13,12 @@ DIR = os.path.dirname(os.path.realpath(__file__))
 
 
 class PGNDataset(Dataset):
-    def __init__(self, tokenizer: Tokenizer, path: str, n_positions=512):
+    def __init__(self, tokenizer: Tokenizer, path: str, n_positions=512, random_window=False):
+        self.path = path
         self.n_positions = n_positions
         self.tokenizer = tokenizer
+        # Take a random n_positions window of long games instead of their opening
+        self.random_window = random_window
         self.games = []
 
         with open(path, "r", encoding="utf-8") as f:
@@ -29,14 +36,120 @@ class PGNDataset(Dataset):
     def __len__(self):
         return len(self.games)
 
+    def max_length(self) -> int:
+        # Longest game with its <bos> and <eos> tokens (the tokenizer maps every move to one token)
+        return max((len(game.split()) for game in self.games), default=0) + 2
+
     def __getitem__(self, i):
         game = self.games[i] #.read_text(encoding="utf-8")
         encoded = self.tokenizer.encode(game, add_bos_token=True)
 
         if len(encoded) < self.n_positions:
             encoded.append(self.tokenizer.eos_token_index)
+        elif self.random_window:
+            encoded.append(self.tokenizer.eos_token_index)
+            start = random.randint(0, len(encoded) - self.n_positions)
+            encoded = encoded[start:start + self.n_positions]
 
         data = self.__pad(encoded)
         return torch.tensor(data)
 
 
+def _vocab_hash(tokenizer: Tokenizer) -> str:
+    vocab = sorted(tokenizer.vocab_dict.items(), key=lambda item: item[1])
+    return hashlib.sha1("\n".join(f"{token}\t{index}" for token, index in vocab).encode("utf-8")).hexdigest()
+
+
+class TokenizedDataset(Dataset):
+    """
+    Games already tokenized and padded, stored as a (games x width) .npy file
+    that is memory-mapped, so several processes can share one copy. A .json
+    file next to it records the source file and vocabulary it was built from.
+
+    Rows can be cut to a smaller n_positions than the width they were written
+    with, either their opening or, with `random_window`, a new random window of
+    long games every time (like PGNDataset) when the rows hold whole games.
+    """
+    def __init__(self, path: str, n_positions=None, random_window=False):
+        self.path = path
+        self.n_positions = n_positions
+        self.random_window = random_window and n_positions is not None
+        self._data = None
+
+        self.length, width = np.load(path, mmap_mode="r").shape
+        assert n_positions is None or n_positions <= width, \
+            f"{path} only holds {width} positions per game"
+        self.pad_token_index = self.metadata(path).get("pad_token_index", Tokenizer.pad_token_index)
+
+    @staticmethod
+    def metadata(path: str) -> dict:
+        try:
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def is_current(path: str, source: str, tokenizer: Tokenizer, width: int) -> bool:
+        """
+        Whether `path` was written from the current `source` file with this
+        tokenizer's vocabulary, with rows of at least `width` positions.
+        """
+        metadata = TokenizedDataset.metadata(path)
+        if not metadata or not os.path.exists(path):
+            return False
+
+        stat = os.stat(source)
+        return (metadata.get("source_size") == stat.st_size
+                and metadata.get("source_mtime_ns") == stat.st_mtime_ns
+                and metadata.get("vocab_hash") == _vocab_hash(tokenizer)
+                and metadata.get("width", 0) >= width)
+
+    @staticmethod
+    def write(dataset: PGNDataset, path: str) -> None:
+        dtype = np.int16 if dataset.tokenizer.vocab_size() < 2 ** 15 else np.int32
+        data = np.lib.format.open_memmap(
+            path, mode="w+", dtype=dtype, shape=(len(dataset), dataset.n_positions))
+
+        for i in range(len(dataset)):
+            data[i] = dataset[i].numpy()
+
+        data.flush()
+        del data
+
+        # Written last: an interrupted write is never mistaken for a current one
+        stat = os.stat(dataset.path)
+        with open(path + ".json", "w", encoding="utf-8") as f:
+            json.dump({
+                "source": dataset.path,
+                "source_size": stat.st_size,
+                "source_mtime_ns": stat.st_mtime_ns,
+                "vocab_hash": _vocab_hash(dataset.tokenizer),
+                "width": dataset.n_positions,
+                "pad_token_index": dataset.tokenizer.pad_token_index,
+            }, f)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        # Opened lazily, so every worker process maps the file itself
+        if self._data is None:
+            self._data = np.load(self.path, mmap_mode="r")
+
+        row = self._data[i]
+        if self.n_positions is not None:
+            start = 0
+            if self.random_window:
+                # Same windows as PGNDataset: games that fit keep their opening and <eos>
+                length = int(np.count_nonzero(row != self.pad_token_index))
+                if length > self.n_positions:
+                    start = random.randint(0, length - self.n_positions)
+            row = row[start:start + self.n_positions]
+
+        return torch.from_numpy(row.astype(np.int64))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
@@ -0,0 +1,351 @@
+import os
+import glob
+import time
+import queue
+import shutil
+import struct
+import threading
+
+from chessutils.tokenizer import Tokenizer
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: segments are not locked, only compact while no store is writing
+    fcntl = None
+
+
+SEGMENT_PREFIX = "games-"
+OFFSET_FORMAT = "<Q"
+
+
+def _lock_file(f, blocking=True) -> bool:
+    # Exclusive lock held by the writer of a segment for as long as it is open
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+class GameStore:
+    """
+    Append-only store of finished games. A background thread batches games and
+    appends them, one per line in the processed_data.txt format, to rotating
+    segment files. Each segment has an index of line offsets (.idx) for random
+    access. Writes are fsync'ed periodically, and sealed segments can be
+    compacted into one deduplicated segment.
+
+    Every store writes to segments it created itself and keeps them locked, so
+    several processes can share a directory. record() only queues the game and
+    never waits for disk.
+    """
+
+    def __init__(self, directory: str, max_segment_bytes: int = 64 * 2 ** 20, batch_size: int = 64,
+                 flush_interval: float = 1.0, fsync_interval: float = 5.0):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+
+        os.makedirs(directory, exist_ok=True)
+
+        self._queue = queue.Queue()
+        self._closed = threading.Event()
+
+        # Guards the open segment; held for buffered writes and reads, never for fsync
+        self._lock = threading.Lock()
+        self._file = None
+        self._index = None
+        self._segment_number = None
+        self._dirty = False
+        self._last_fsync = time.monotonic()
+
+        # Games queued, written and fsync'ed so far, for flush()
+        self._progress = threading.Condition()
+        self._queued = 0
+        self._written = 0
+        self._synced = 0
+        self._sync_target = 0
+
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _number(path: str) -> int:
+        return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(".txt")])
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{number:06d}.txt")
+
+    def segments(self) -> list:
+        return sorted(glob.glob(os.path.join(self.directory, f"{SEGMENT_PREFIX}*.txt")), key=self._number)
+
+    def _open_segment(self) -> None:
+        # Claim a new segment: O_EXCL makes sure no other process writes to it
+        segments = self.segments()
+        number = self._number(segments[-1]) + 1 if segments else 1
+
+        while True:
+            path = self._segment_path(number)
+            try:
+                flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | os.O_APPEND | getattr(os, "O_BINARY", 0)
+                fd = os.open(path, flags)
+            except FileExistsError:
+                number += 1
+                continue
+
+            f = os.fdopen(fd, "ab")
+            _lock_file(f)
+
+            # A compaction may have removed the empty segment before it was locked
+            if os.path.exists(path) and os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                break
+            f.close()
+            number += 1
+
+        self._segment_number = number
+        self._file = f
+        self._index = open(path[:-len(".txt")] + ".idx", "ab")
+        self._dirty = False
+
+    def _sync(self) -> None:
+        # Only called by the writer thread (or after it stopped), so the files cannot be closed meanwhile
+        with self._lock:
+            if not self._dirty:
+                files = []
+            else:
+                self._file.flush()
+                self._index.flush()
+                files = [self._file, self._index]
+                self._dirty = False
+
+        for f in files:
+            os.fsync(f.fileno())
+        self._last_fsync = time.monotonic()
+
+    def record(self, moves: str) -> None:
+        """
+        Queues a finished game (space separated moves, special tokens are dropped).
+        Never blocks on disk.
+        """
+        special = {Tokenizer.pad_token, Tokenizer.bos_token, Tokenizer.eos_token, Tokenizer.unk_token}
+        game = " ".join(move for move in moves.split() if move not in special)
+        if not game:
+            return
+
+        with self._progress:
+            self._queued += 1
+        self._queue.put(game)
+
+    def _write_batch(self, batch: list) -> None:
+        sealed = []
+
+        with self._lock:
+            for game in batch:
+                if self._file is None:
+                    self._open_segment()
+                elif self._file.tell() >= self.max_segment_bytes:
+                    sealed += [self._file, self._index]
+                    self._open_segment()
+
+                self._index.write(struct.pack(OFFSET_FORMAT, self._file.tell()))
+                self._file.write((game + "\n").encode("utf-8"))
+
+            # The data goes out before the offsets that point to it
+            self._file.flush()
+            self._index.flush()
+            self._dirty = True
+
+        for f in sealed:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+
+    def _write_loop(self) -> None:
+        while not (self._closed.is_set() and self._queue.empty()):
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            # None only wakes the writer up (flush or close)
+            batch = [game for game in batch if game is not None]
+            if batch:
+                self._write_batch(batch)
+
+            with self._progress:
+                self._written += len(batch)
+                written = self._written
+                requested = self._synced < self._sync_target <= written
+
+            if requested or time.monotonic() - self._last_fsync >= self.fsync_interval:
+                self._sync()
+                with self._progress:
+                    self._synced = written
+                    self._progress.notify_all()
+
+    def flush(self, timeout: float = None) -> None:
+        """
+        Waits until every game queued so far is written and fsync'ed.
+        """
+        with self._progress:
+            target = self._queued
+            if self._synced >= target:
+                return
+            self._sync_target = max(self._sync_target, target)
+
+        self._queue.put(None)
+        with self._progress:
+            self._progress.wait_for(lambda: self._synced >= target, timeout=timeout)
+
+    def close(self) -> None:
+        self._closed.set()
+        self._queue.put(None)
+        self._thread.join()
+        self._sync()
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._index.close()
+                self._file = self._index = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            if self._index is not None:
+                self._index.flush()
+            return sum(os.path.getsize(path[:-len(".txt")] + ".idx") // struct.calcsize(OFFSET_FORMAT)
+                       for path in self.segments())
+
+    def read(self, i: int) -> str:
+        """
+        Returns the i-th stored game, located through the segment indexes.
+        """
+        entry_size = struct.calcsize(OFFSET_FORMAT)
+
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._index.flush()
+
+            for path in self.segments():
+                index_path = path[:-len(".txt")] + ".idx"
+                count = os.path.getsize(index_path) // entry_size
+                if i >= count:
+                    i -= count
+                    continue
+
+                with open(index_path, "rb") as index, open(path, "rb") as f:
+                    index.seek(i * entry_size)
+                    offset, = struct.unpack(OFFSET_FORMAT, index.read(entry_size))
+                    f.seek(offset)
+                    return f.readline().decode("utf-8").rstrip("\n")
+
+        raise IndexError("Game index out of range")
+
+    def compact(self) -> int:
+        """
+        Merges all sealed segments (those no store is writing to) into a single
+        segment without duplicate games. Returns the number of games dropped.
+        """
+        with self._lock:
+            own = self._segment_number if self._file is not None else None
+
+        # A segment is sealed if its lock is free, i.e. its writer moved on or exited
+        sealed, locks = [], []
+        for path in self.segments():
+            if self._number(path) == own:
+                continue
+            f = open(path, "rb")
+            if _lock_file(f, blocking=False):
+                sealed.append(path)
+                locks.append(f)
+            else:
+                f.close()
+
+        try:
+            if not sealed:
+                return 0
+
+            target = sealed[0]
+            tmp_path, tmp_index_path = target + ".compact", target[:-len(".txt")] + ".idx.compact"
+            seen, dropped = set(), 0
+
+            with open(tmp_path, "wb") as out, open(tmp_index_path, "wb") as out_index:
+                for f in locks:
+                    for line in f:
+                        if line in seen:
+                            dropped += 1
+                            continue
+                        seen.add(line)
+                        out_index.write(struct.pack(OFFSET_FORMAT, out.tell()))
+                        out.write(line)
+                out.flush()
+                out_index.flush()
+                os.fsync(out.fileno())
+                os.fsync(out_index.fileno())
+
+            # Readers hold the lock, so they never see a half-replaced set of segments
+            with self._lock:
+                os.replace(tmp_path, target)
+                os.replace(tmp_index_path, target[:-len(".txt")] + ".idx")
+                for path in sealed[1:]:
+                    os.remove(path)
+                    os.remove(path[:-len(".txt")] + ".idx")
+        finally:
+            for f in locks:
+                f.close()
+
+        return dropped
+
+    def export(self, path: str) -> None:
+        """
+        Writes all stored games to `path` in the processed_data.txt format read
+        by PGNDataset. Segments already use that format, so this is a byte copy.
+        """
+        self.flush()
+
+        with self._lock:
+            segments = self.segments()
+            with open(path, "wb") as out:
+                for segment in segments:
+                    with open(segment, "rb") as f:
+                        shutil.copyfileobj(f, out)
+
+    def export_tokenized(self, path: str, tokenizer: Tokenizer, n_positions: int) -> None:
+        """
+        Writes all stored games as a TokenizedDataset (.npy) ready for training.
+        """
+        from chessutils.dataset import PGNDataset, TokenizedDataset
+
+        text_path = path + ".txt"
+        self.export(text_path)
+        try:
+            TokenizedDataset.write(PGNDataset(tokenizer, text_path, n_positions=n_positions), path)
+        finally:
+            os.remove(text_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='CheckMate game store maintenance')
+    parser.add_argument('directory', type=str, help='Game store directory')
+    parser.add_argument('--compact', action='store_true', help='Merge and deduplicate sealed segments')
+    parser.add_argument('--export', type=str, default=None, help='Export games in the processed_data.txt format')
+    args = parser.parse_args()
+
+    store = GameStore(args.directory)
+    if args.compact:
+        print(f"Compaction dropped {store.compact()} duplicate games.")
+    if args.export:
+        store.export(args.export)
+        print(f"Exported {len(store)} games to {args.export}.")
+    store.close()
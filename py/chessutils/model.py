@@ -4,8 +4,10 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch.nn.modules.transformer import TransformerEncoder, TransformerEncoderLayer
 
+from chessutils.rotary import CachePool, RollingKVCache, RotaryEncoder, RotaryEncoderLayer
 from chessutils.tokenizer import Tokenizer
 
 
@@ -56,6 +58,10 @@ class Transformer(nn.Module):
         num_layers: int,
         dropout_p: float,
         n_positions: int,
+        checkpoint_activations: bool = False,
+        exit_layers: list = None,
+        position_encoding: str = "sinusoidal",
+        cache_pool_size: int = 64,
     ):
         super().__init__()
 
@@ -66,66 +72,314 @@ class Transformer(nn.Module):
         self.dim_model = dim_model
         self.n_positions = n_positions
 
+        # Recompute each encoder layer's activations during backward instead of storing them
+        self.checkpoint_activations = checkpoint_activations
+
+        # "sinusoidal" (absolute, fixed window) or "rotary" (relative, supports a rolling cache)
+        assert position_encoding in ("sinusoidal", "rotary"), \
+            f"Unknown position encoding: {position_encoding}"
+        self.position_encoding = position_encoding
+
         # LAYERS
-        self.positional_encoder = PositionalEncoding(
-            dim_model=dim_model, dropout_p=dropout_p, max_len=n_positions
-        )
         self.embedding = nn.Embedding(
             num_tokens, dim_model, padding_idx=self.tokenizer.pad_token_index)
 
-        encoder_layers = TransformerEncoderLayer(
-            dim_model,
-            num_heads,
-            d_hid,
-            dropout_p,
-            batch_first=False,
-            activation=F.gelu,
-            norm_first=True,
-        )
-        self.transformer_encoder = TransformerEncoder(
-            encoder_layers, num_layers)
+        if position_encoding == "rotary":
+            # Positions are applied inside attention, only the dropout remains here
+            self.positional_encoder = nn.Dropout(dropout_p)
+            encoder_layers = RotaryEncoderLayer(dim_model, num_heads, d_hid, dropout_p)
+            self.transformer_encoder = RotaryEncoder(encoder_layers, num_layers)
+
+            # Caches of recently predicted games, reused when the same game continues
+            self.cache_pool = CachePool(cache_pool_size)
+        else:
+            self.positional_encoder = PositionalEncoding(
+                dim_model=dim_model, dropout_p=dropout_p, max_len=n_positions
+            )
+            encoder_layers = TransformerEncoderLayer(
+                dim_model,
+                num_heads,
+                d_hid,
+                dropout_p,
+                batch_first=False,
+                activation=F.gelu,
+                norm_first=True,
+            )
+            self.transformer_encoder = TransformerEncoder(
+                encoder_layers, num_layers)
 
         self.out = nn.Linear(dim_model, num_tokens)
 
+        # Early-exit heads after intermediate layers (1-based), sharing self.out
+        self.exit_layers = sorted(exit_layers or [])
+        assert all(0 < layer < num_layers for layer in self.exit_layers), \
+            "Exit layers must be between 1 and num_layers - 1"
+        self.exit_norms = nn.ModuleDict({
+            str(layer): nn.LayerNorm(dim_model) for layer in self.exit_layers
+        })
+
+        # Number of layers executed for every move of the last early-exit predict call
+        self.layers_executed = []
+
+        # Optional shape-bucketed (traced/compiled) forward used by predict, see chessutils.bucketing
+        self.bucketed_forward = None
+
         self.init_weights()
 
     def init_weights(self) -> None:
         nn.init.xavier_uniform_(self.embedding.weight)
         nn.init.xavier_uniform_(self.out.weight)
 
-    def forward(self, src, src_mask=None, src_pad_mask=None) -> torch.Tensor:
-        # Embedding + positional encoding - Out size = (batch_size, sequence length, dim_model)
+    def embed(self, src) -> torch.Tensor:
+        # Embedding + positional encoding - Out size = (sequence length, batch_size, dim_model)
         src = self.embedding(src) * math.sqrt(self.dim_model)
-        src = self.positional_encoder(src)
+        return self.positional_encoder(src)
+
+    def encode(self, src, src_mask=None, src_pad_mask=None) -> torch.Tensor:
+        src = self.embed(src)
+
+        if self.checkpoint_activations and self.training and torch.is_grad_enabled():
+            # Only the input of every layer is kept, the rest is recomputed in backward
+            for layer in self.transformer_encoder.layers:
+                src = checkpoint(layer, src, src_mask, src_pad_mask, use_reentrant=False)
+            return src
 
-        # Transformer blocks - Out size = (sequence length, batch_size, num_tokens)
-        transformer_out = self.transformer_encoder(
+        # Transformer blocks - Out size = (sequence length, batch_size, dim_model)
+        return self.transformer_encoder(
             src,
             src_mask,
             src_pad_mask,
         )
 
+    def forward(self, src, src_mask=None, src_pad_mask=None, last_only=False) -> torch.Tensor:
+        transformer_out = self.encode(src, src_mask, src_pad_mask)
+
+        if last_only:
+            # Only the next token is needed: skip the projection of earlier positions
+            transformer_out = transformer_out[-1:]
+
+        # Out size = (sequence length, batch_size, num_tokens)
         out = self.out(transformer_out)
 
         return F.log_softmax(out, dim=-1)
 
+    def new_cache(self) -> RollingKVCache:
+        assert self.position_encoding == "rotary", "The rolling cache requires rotary position encoding"
+        return RollingKVCache(len(self.transformer_encoder.layers), self.n_positions - 1)
+
+    def forward_cached(self, src, cache: RollingKVCache, all_positions=False) -> torch.Tensor:
+        """
+        Runs only the tokens not yet in `cache` (sequence length, 1), attending to
+        the cached keys/values of the last n_positions - 1 tokens, and returns
+        the log-probs of the last position (of every new position with
+        `all_positions`). The cost per new token does not depend on how long the
+        game already is.
+        """
+        positions = torch.arange(cache.length, cache.length + src.size(0), device=src.device)
+        cache.tokens.extend(src.view(-1).tolist())
+        src = self.embed(src)
+
+        for i, layer in enumerate(self.transformer_encoder.layers):
+            src = layer(src, positions=positions, cache=cache, index=i)
+
+        cache.advance(positions)
+        return F.log_softmax(self.out(src if all_positions else src[-1:]), dim=-1)
+
+    def _chunk_nll(self, hidden, targets) -> torch.Tensor:
+        return F.cross_entropy(self.out(hidden), targets, reduction="sum")
+
+    def chunked_nll_loss(self, hidden, targets, chunk_size=1024, ignore_index=None) -> torch.Tensor:
+        """
+        Mean NLL of `targets` given the encoder output `hidden`, equivalent to
+        NLLLoss over forward() but without the full (sequence x batch x vocab)
+        log-probs: padding targets are dropped, and the output projection and
+        cross-entropy run `chunk_size` tokens at a time, recomputing each chunk's
+        logits in backward instead of storing them.
+        """
+        if ignore_index is None:
+            ignore_index = self.tokenizer.pad_token_index
+
+        targets = targets.reshape(-1)
+        hidden = hidden.reshape(-1, hidden.size(-1))
+
+        keep = targets != ignore_index
+        hidden, targets = hidden[keep], targets[keep]
+
+        total = hidden.new_zeros(())
+        for start in range(0, targets.size(0), chunk_size):
+            chunk_hidden = hidden[start:start + chunk_size]
+            chunk_targets = targets[start:start + chunk_size]
+            if torch.is_grad_enabled():
+                total = total + checkpoint(self._chunk_nll, chunk_hidden, chunk_targets, use_reentrant=False)
+            else:
+                total = total + self._chunk_nll(chunk_hidden, chunk_targets)
+
+        return total / max(targets.size(0), 1)
+
+    def forward_exits(self, src, src_mask=None, src_pad_mask=None) -> list:
+        """
+        Runs the encoder layer by layer and returns a list of (layer, log-probs)
+        pairs, one for every early-exit head.
+        """
+        src = self.embed(src)
+        outputs = []
+
+        for i, layer in enumerate(self.transformer_encoder.layers, 1):
+            src = layer(src, src_mask, src_pad_mask)
+            if str(i) in self.exit_norms:
+                exit_out = self.out(self.exit_norms[str(i)](src))
+                outputs.append((i, F.log_softmax(exit_out, dim=-1)))
+
+        return outputs
+
+    def early_exit_log_probs(self, input_ids, legal_mask, threshold) -> tuple:
+        """
+        Returns the log-probs of the next token (last position only) and the
+        number of layers executed, stopping at the first exit head whose
+        legal-masked distribution is at least `threshold` confident.
+        """
+        src_mask = self.get_src_mask(input_ids.size(0)).to(input_ids.device).bool()
+        pad_mask = self.get_pad_mask(input_ids, self.tokenizer.pad_token_index).to(input_ids.device)
+
+        src = self.embed(input_ids)
+        layers = self.transformer_encoder.layers
+
+        for i, layer in enumerate(layers, 1):
+            src = layer(src, src_mask, pad_mask)
+            if str(i) in self.exit_norms:
+                exit_out = self.out(self.exit_norms[str(i)](src[-1, 0]))
+                log_probs = F.log_softmax(exit_out, dim=-1)
+                if self.exit_confidence(log_probs, legal_mask) >= threshold:
+                    return log_probs, i
+
+        return F.log_softmax(self.out(src[-1, 0]), dim=-1), len(layers)
+
+    def exit_confidence(self, log_probs, legal_mask) -> float:
+        # Probability of the most likely legal move, renormalized over legal moves only
+        probs = log_probs.exp() * legal_mask.to(log_probs.device)
+        total = probs.sum()
+        return (probs.max() / total).item() if total > 0 else 0.0
+
+    def get_legal_mask(self, board) -> torch.Tensor:
+        mask = torch.zeros(self.out.out_features, dtype=torch.bool)
+
+        for move in board.legal_moves:
+            index = self.tokenizer.vocab_dict.get(board.san(move))
+            if index is not None:
+                mask[index] = True
+
+        return mask
+
     def get_src_mask(self, sz) -> torch.Tensor:
         return torch.triu(torch.ones(sz, sz) * float('-inf'), diagonal=1)
 
     def get_pad_mask(self, matrix: torch.Tensor, pad_token: int) -> torch.Tensor:
         return (matrix == pad_token).t()
 
+    def next_log_probs(self, y_input, board, exit_threshold=None, cache=None) -> torch.Tensor:
+        """
+        Log-probs of the token following `y_input` (sequence length, 1), running
+        the model on the last `n_positions` tokens only, or only on the tokens
+        not yet seen by `cache` when a rolling cache is given.
+        """
+        if cache is not None:
+            # Skipped layers would leave their cache entries stale, and cached steps have a fixed shape anyway
+            if exit_threshold is not None and self.exit_layers:
+                raise RuntimeError("Early exit is not supported with the rolling cache of rotary models")
+            if self.bucketed_forward is not None:
+                raise RuntimeError("Bucketing is not supported with the rolling cache of rotary models")
+            return self.forward_cached(y_input[cache.length:], cache)[-1].squeeze()
+
+        y_size = y_input.size(0)
+        begin_loc = max(y_size - self.n_positions, 0)
+
+        if y_size > self.n_positions and begin_loc % 2 != 0:
+            # Let's help the model know what turn it is
+            begin_loc += 1
+
+        end_loc = min(begin_loc + self.n_positions, y_size)
+        input_ids = y_input[begin_loc:end_loc]
+
+        if exit_threshold is not None and self.exit_layers:
+            # Stop at the first exit head that is confident enough about a legal move
+            # (never bucketed: play.py rejects --exit_threshold together with --bucketing)
+            next_log_probs, layers = self.early_exit_log_probs(
+                input_ids, self.get_legal_mask(board), exit_threshold)
+            self.layers_executed.append(layers)
+            return next_log_probs
+
+        if self.bucketed_forward is not None:
+            return self.bucketed_forward(input_ids)
+
+        src_mask = self.get_src_mask(input_ids.size(0)).to("cpu")
+        pad_mask = self.get_pad_mask(
+            input_ids, self.tokenizer.pad_token_index).to("cpu")
+
+        pred = self.forward(input_ids, src_mask, pad_mask, last_only=True)
+        return pred[-1].squeeze()
+
+    def sample_next_token(self, next_log_probs, board, temperature):
+        """
+        Samples 10 candidates from the tempered distribution and returns the first
+        legal one, or None if none of them is legal.
+        """
+        word_weights = next_log_probs.div(temperature).exp()
+        word_idx = torch.multinomial(word_weights, 10)
+
+        for wi in word_idx:
+            decoded = self.tokenizer.decode([wi])
+            try:
+                board.parse_san(decoded)
+                return wi
+            except:
+                continue
+
+        return None
+
+    def draft_tokens(self, sequence, board, num_tokens) -> list:
+        """
+        Greedily proposes up to `num_tokens` legal moves following `sequence`
+        (a list of token ids) from the position `board`, without modifying it.
+        """
+        board = board.copy(stack=False)
+        tokens = []
+
+        for _ in range(num_tokens):
+            legal_mask = self.get_legal_mask(board)
+            if not legal_mask.any():
+                break
+
+            y_input = torch.tensor([sequence + tokens], dtype=torch.long, device="cpu").t()
+            next_log_probs = self.next_log_probs(y_input, board)
+            token = next_log_probs.masked_fill(~legal_mask, float("-inf")).argmax().item()
+
+            tokens.append(token)
+            board.push_san(self.tokenizer.decode([token]))
+
+            if board.is_checkmate():
+                break
+
+        return tokens
+
     def predict(
         self,
         input_string: str = "<bos>",
         max_length=80, 
         stop_at_next_move=False, 
-        temperature=0.5
+        temperature=0.5,
+        exit_threshold=None,
+        draft_model=None,
+        num_draft=4,
     ) -> str:
         import chess
 
+        if draft_model is not None and not stop_at_next_move:
+            return self.predict_speculative(
+                draft_model, input_string, max_length, temperature, num_draft)
+
         board = chess.Board()
         self.eval()
+        self.layers_executed = []
 
         input_sequence = self.tokenizer.encode(
             input_string, add_bos_token=False)
@@ -139,41 +393,21 @@ class Transformer(nn.Module):
         y_input = torch.tensor(
             [input_sequence], dtype=torch.long, device="cpu").t()
 
+        # With rotary encoding every new ply only runs the new token against the cache
+        cache = None
+        if self.position_encoding == "rotary":
+            cache = self.cache_pool.take(input_sequence) or self.new_cache()
+
         if stop_at_next_move:
             max_length = 1
         else: 
             max_length -= len(input_sequence)
 
         for _ in range(max_length):
-            y_size = y_input.size(0)
-            begin_loc = max(y_size - self.n_positions, 0)
-
-            if y_size > self.n_positions and begin_loc % 2 != 0:
-                # Let's help the model know what turn it is
-                begin_loc += 1
-
-            end_loc = min(begin_loc + self.n_positions, y_size)
-            input_ids = y_input[begin_loc:end_loc]
-            
-            src_mask = self.get_src_mask(input_ids.size(0)).to("cpu")
-            pad_mask = self.get_pad_mask(
-                input_ids, self.tokenizer.pad_token_index).to("cpu")
-
-            pred = self.forward(input_ids, src_mask, pad_mask)
-
-            word_weights = pred[-1].squeeze().div(temperature).exp()
-            word_idx = torch.multinomial(word_weights, 10)
-
-            for wi in word_idx:
-                decoded = self.tokenizer.decode([wi])
-                try:
-                    board.parse_san(decoded)
-                    word_idx = wi
-                    break
-                except:
-                    continue
+            next_log_probs = self.next_log_probs(y_input, board, exit_threshold, cache)
+            word_idx = self.sample_next_token(next_log_probs, board, temperature)
 
-            if word_idx.ndim > 0:
+            if word_idx is None:
                 # If the model doesn't know what to move, surrenders
                 next_item = torch.tensor([[self.tokenizer.eos_token_index]], device="cpu")
                 y_input = torch.cat((y_input, next_item), dim=0)
@@ -195,4 +429,147 @@ class Transformer(nn.Module):
             if next_item.view(-1).item() == self.tokenizer.eos_token_index:
                 break
 
-        return self.tokenizer.decode(y_input.view(-1).tolist())
\ No newline at end of file
+        if cache is not None:
+            self.cache_pool.put(cache)
+
+        return self.tokenizer.decode(y_input.view(-1).tolist())
+
+    def predict_speculative(
+        self,
+        draft_model,
+        input_string: str = "<bos>",
+        max_length=80,
+        temperature=0.5,
+        num_draft=4,
+    ) -> str:
+        """
+        Same output distribution as predict(stop_at_next_move=False), but a small
+        draft model proposes up to `num_draft` plies that this model verifies in
+        a single forward. At every drafted position this model samples its own
+        move exactly as predict would; drafted moves are accepted while the two
+        agree, and the first disagreement is replaced by this model's sample.
+        Rotary models verify drafts against their rolling cache, which is rolled
+        back when a draft is rejected, so games can outgrow n_positions.
+        """
+        import chess
+
+        assert draft_model.out.out_features == self.out.out_features, \
+            "The draft model must share the tokenizer of the main model"
+
+        board = chess.Board()
+        self.eval()
+        draft_model.eval()
+        self.speculative_stats = {"forwards": 0, "drafted": 0, "accepted": 0}
+
+        sequence = self.tokenizer.encode(input_string, add_bos_token=False)
+
+        for token in input_string.split(" ")[1:]:
+            board.push_san(token)
+
+        remaining = max_length - len(sequence)
+        finished = False
+
+        cache = None
+        if self.position_encoding == "rotary":
+            cache = self.cache_pool.take(sequence) or self.new_cache()
+
+        while remaining > 0 and not finished:
+            # Keep one slot for the token sampled after the last drafted one
+            num_tokens = min(num_draft, remaining - 1)
+            if cache is None:
+                num_tokens = min(num_tokens, self.n_positions - len(sequence) - 1)
+
+            if cache is not None:
+                draft = draft_model.draft_tokens(sequence, board, num_tokens) if num_tokens > 0 else []
+                state = cache.snapshot()
+                new_tokens = sequence[cache.length:] + draft
+                y_input = torch.tensor([new_tokens], dtype=torch.long, device="cpu").t()
+
+                # Only the tokens not yet cached and the drafted plies run, in one forward
+                pred = self.forward_cached(y_input, cache, all_positions=True)
+                offset = len(new_tokens) - len(draft) - 1
+                candidates = [pred[offset + j].squeeze() for j in range(len(draft) + 1)]
+            elif num_tokens > 0:
+                draft = draft_model.draft_tokens(sequence, board, num_tokens)
+                y_input = torch.tensor([sequence + draft], dtype=torch.long, device="cpu").t()
+                src_mask = self.get_src_mask(y_input.size(0)).to("cpu")
+                pad_mask = self.get_pad_mask(
+                    y_input, self.tokenizer.pad_token_index).to("cpu")
+
+                # One forward verifies every drafted ply
+                pred = self.forward(y_input, src_mask, pad_mask)
+                candidates = [pred[len(sequence) - 1 + j].squeeze() for j in range(len(draft) + 1)]
+            else:
+                # Past the window: regular step with the sliding window of predict
+                draft = []
+                y_input = torch.tensor([sequence], dtype=torch.long, device="cpu").t()
+                candidates = [self.next_log_probs(y_input, board)]
+
+            self.speculative_stats["forwards"] += 1
+            self.speculative_stats["drafted"] += len(draft)
+
+            for j, next_log_probs in enumerate(candidates):
+                word_idx = self.sample_next_token(next_log_probs, board, temperature)
+
+                if word_idx is None:
+                    # If the model doesn't know what to move, surrenders
+                    sequence.append(self.tokenizer.eos_token_index)
+                    finished = True
+                    break
+
+                word_idx = int(word_idx)
+                board.push_san(self.tokenizer.decode([word_idx]))
+                sequence.append(word_idx)
+                remaining -= 1
+
+                if board.is_checkmate():
+                    # If it checkmates the opponent, return with <eos>
+                    sequence.append(self.tokenizer.eos_token_index)
+                    finished = True
+                    break
+
+                if j >= len(draft) or word_idx != draft[j]:
+                    # Later drafted plies were conditioned on a different move
+                    break
+
+                self.speculative_stats["accepted"] += 1
+
+            if cache is not None and cache.tokens != sequence[:cache.length]:
+                # A drafted ply was rejected: its keys/values must not stay in the cache
+                cache.restore(state)
+
+        if cache is not None:
+            self.cache_pool.put(cache)
+
+        return self.tokenizer.decode(sequence)
+
+
+def build_model(config: dict, tokenizer: Tokenizer, **kwargs) -> Transformer:
+    """
+    Builds a Transformer from the "model" section of a configuration. Extra
+    keyword arguments (e.g. cache_pool_size) are passed to the constructor.
+    """
+    return Transformer(
+        tokenizer=tokenizer,
+        num_tokens=tokenizer.vocab_size(),
+        dim_model=config["model"]["dim_model"],
+        d_hid=config["model"]["d_hid"],
+        num_heads=config["model"]["num_heads"],
+        num_layers=config["model"]["num_layers"],
+        dropout_p=config["model"]["dropout_p"],
+        n_positions=config["model"]["n_positions"],
+        exit_layers=config["model"].get("exit_layers"),
+        position_encoding=config["model"].get("position_encoding", "sinusoidal"),
+        **kwargs,
+    )
+
+
+def load_checkpoint(path: str, map_location=None) -> dict:
+    """
+    Loads a state dict without unpickling arbitrary objects where torch supports it.
+    """
+    try:
+        return torch.load(path, map_location=map_location, weights_only=True)
+    except TypeError:
+        # torch < 1.13 has no weights_only
+        return torch.load(path, map_location=map_location)
@@ -0,0 +1,222 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import torch
+
+from chessutils.model import Transformer
+from chessutils.registry import ModelEntry
+
+
+class _PonderTask:
+    # Answers precomputed for one session while the human is thinking
+    def __init__(self, entry: ModelEntry, position: str, deadline: float):
+        # The entry, not its name: a hot-swapped model must not serve replies of the old one
+        self.entry = entry
+        self.position = position
+        self.deadline = deadline
+        self.cache = {}
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+
+class Ponderer:
+    """
+    Precomputes the engine's replies to the human's most likely next moves while
+    the human is thinking. One task is queued per session; it is cancelled when
+    the real move arrives, and a matching precomputed reply is returned instantly.
+    Tasks run on a small fixed pool of workers and yield to foreground requests
+    (see foreground()), so pondering never takes compute from a real move.
+    """
+
+    def __init__(self, max_candidates: int = 3, time_budget: float = 2.0, max_sessions: int = 256,
+                 workers: int = 1):
+        self.max_candidates = max_candidates
+        self.time_budget = time_budget
+        self.max_sessions = max_sessions
+        self.workers = workers
+
+        self._tasks = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ponder")
+
+        # Foreground requests in flight, pondering waits for them to finish
+        self._foreground = 0
+        self._idle = threading.Condition(self._lock)
+
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "precomputed": 0,
+            "wasted": 0,
+            "skipped": 0,
+            "ponder_seconds": 0.0,
+            "wasted_seconds": 0.0,
+        }
+
+    @contextmanager
+    def foreground(self):
+        """
+        Wraps a foreground prediction; pondering pauses while any is running.
+        """
+        with self._lock:
+            self._foreground += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._foreground -= 1
+                self._idle.notify_all()
+
+    def lookup(self, session_id: str, entry: ModelEntry, input_moves: str):
+        """
+        Cancels the session's pondering and returns the precomputed reply to
+        `input_moves`, or None on a miss.
+        """
+        with self._lock:
+            task = self._tasks.pop(session_id, None)
+
+        if task is None:
+            return None
+
+        with task.lock:
+            task.cancelled = True
+            cache = dict(task.cache)
+
+        # Wake a worker waiting to run this task, so it moves on to the next one
+        with self._idle:
+            self._idle.notify_all()
+
+        reply = None
+        if task.entry is entry and input_moves in cache:
+            reply, _ = cache.pop(input_moves)
+
+        with self._lock:
+            self._stats["hits" if reply is not None else "misses"] += 1
+            self._stats["wasted"] += len(cache)
+            self._stats["wasted_seconds"] += sum(seconds for _, seconds in cache.values())
+
+        return reply
+
+    def start(self, session_id: str, entry: ModelEntry, position: str, **predict_kwargs) -> None:
+        """
+        Queues pondering on `position` (the moves after the engine's reply) for
+        the worker pool, replacing any previous task of the session. The time
+        budget counts from now, including the time spent queued.
+        """
+        task = _PonderTask(entry, position, time.perf_counter() + self.time_budget)
+
+        with self._lock:
+            previous = self._tasks.pop(session_id, None)
+            self._tasks[session_id] = task
+
+            # Forget the least recently active sessions
+            evicted = []
+            while len(self._tasks) > self.max_sessions:
+                evicted.append(self._tasks.popitem(last=False)[1])
+
+        # Cancelled outside the lock, which _cancel takes itself
+        for old_task in evicted + ([previous] if previous is not None else []):
+            self._cancel(old_task)
+
+        self._executor.submit(self._ponder, task, predict_kwargs)
+
+    def _cancel(self, task: _PonderTask) -> None:
+        with task.lock:
+            task.cancelled = True
+            cache = dict(task.cache)
+
+        with self._lock:
+            self._stats["wasted"] += len(cache)
+            self._stats["wasted_seconds"] += sum(seconds for _, seconds in cache.values())
+            self._idle.notify_all()
+
+    def likely_moves(self, model: Transformer, position: str) -> list:
+        """
+        The human's most likely legal moves from `position`, by model probability.
+        """
+        import chess
+
+        board = chess.Board()
+        for token in position.split(" ")[1:]:
+            board.push_san(token)
+
+        legal_mask = model.get_legal_mask(board)
+        if board.is_game_over() or not legal_mask.any():
+            return []
+
+        sequence = model.tokenizer.encode(position, add_bos_token=False)
+        y_input = torch.tensor([sequence], dtype=torch.long, device="cpu").t()
+
+        with torch.no_grad():
+            next_log_probs = model.next_log_probs(y_input, board)
+
+        next_log_probs = next_log_probs.masked_fill(~legal_mask.to(next_log_probs.device), float("-inf"))
+        k = min(self.max_candidates, int(legal_mask.sum().item()))
+        indices = torch.topk(next_log_probs, k).indices.tolist()
+        return [model.tokenizer.decode([index]) for index in indices]
+
+    def _wait_until_idle(self, task: _PonderTask) -> bool:
+        # Whether the task may run now: no foreground request in flight, not cancelled, in budget
+        with self._idle:
+            self._idle.wait_for(lambda: self._foreground == 0 or task.cancelled,
+                                timeout=max(0.0, task.deadline - time.perf_counter()))
+            return self._foreground == 0 and not task.cancelled and time.perf_counter() < task.deadline
+
+    def _ponder(self, task: _PonderTask, predict_kwargs: dict) -> None:
+        model = task.entry.model
+
+        if not self._wait_until_idle(task):
+            with self._lock:
+                self._stats["skipped"] += 1
+            return
+
+        try:
+            candidates = self.likely_moves(model, task.position)
+        except Exception as e:
+            print(f"Pondering failed: {e}")
+            return
+
+        for move in candidates:
+            if not self._wait_until_idle(task):
+                break
+
+            input_moves = task.position + " " + move
+            start = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    reply = model.predict(input_moves, stop_at_next_move=True, **predict_kwargs)
+            except Exception:
+                continue
+            seconds = time.perf_counter() - start
+
+            with task.lock:
+                cancelled = task.cancelled
+                if not cancelled:
+                    task.cache[input_moves] = (reply, seconds)
+
+            with self._lock:
+                self._stats["ponder_seconds"] += seconds
+                if cancelled:
+                    # The real move arrived while this reply was being computed
+                    self._stats["wasted"] += 1
+                    self._stats["wasted_seconds"] += seconds
+                else:
+                    self._stats["precomputed"] += 1
+
+    def status(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["active_sessions"] = len(self._tasks)
+
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["wasted_fraction"] = (
+            stats["wasted_seconds"] / stats["ponder_seconds"] if stats["ponder_seconds"] else 0.0
+        )
+        stats["max_candidates"] = self.max_candidates
+        stats["time_budget"] = self.time_budget
+        stats["workers"] = self.workers
+        return stats
@@ -0,0 +1,176 @@
+import time
+import threading
+
+import torch
+
+from chessutils.bucketing import BucketedForward
+from chessutils.configuration import get_configuration
+from chessutils.model import Transformer, build_model, load_checkpoint
+from chessutils.tokenizer import Tokenizer
+
+
+def model_memory_bytes(model: torch.nn.Module) -> int:
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelEntry:
+    def __init__(self, name: str, model: Transformer, checkpoint_path: str, config_path: str):
+        self.name = name
+        self.model = model
+        self.checkpoint_path = checkpoint_path
+        self.config_path = config_path
+
+        self.loaded_at = time.time()
+        self.load_seconds = 0.0
+        self.warmup_seconds = 0.0
+        self.swap_seconds = 0.0
+        self.bucket_warmup_seconds = {}
+
+    def status(self) -> dict:
+        cache_pool = getattr(self.model, "cache_pool", None)
+
+        return {
+            "checkpoint": self.checkpoint_path,
+            "config": self.config_path,
+            "parameters": sum(p.numel() for p in self.model.parameters()),
+            "memory_mb": model_memory_bytes(self.model) / 2 ** 20,
+            "cache_pool_entries": len(cache_pool) if cache_pool is not None else 0,
+            "cache_pool_mb": cache_pool.memory_bytes() / 2 ** 20 if cache_pool is not None else 0.0,
+            "loaded_at": self.loaded_at,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "swap_ms": 1000 * self.swap_seconds,
+            "bucket_warmup_seconds": self.bucket_warmup_seconds,
+        }
+
+
+class ModelRegistry:
+    """
+    Holds several named models. Models are loaded and warmed up in a background
+    thread and only then swapped in under a lock, so requests always see either
+    the old or the new model, never a half-loaded one. Requests keep a reference
+    to the entry they got, which keeps a swapped-out model alive until they finish.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, device: torch.device, default: str = "default",
+                 bucketing: str = None, buckets: list = None, cache_pool_size: int = 64):
+        self.tokenizer = tokenizer
+        self.device = device
+        self.default = default
+
+        # Shape-bucketed inference mode ("eager", "trace" or "compile"), None to disable
+        self.bucketing = bucketing
+        self.buckets = buckets
+
+        # Rolling caches kept per rotary model for games that continue
+        self.cache_pool_size = cache_pool_size
+
+        self._models = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def load(self, name: str, checkpoint_path: str, config_path: str, block=False) -> threading.Thread:
+        # A checkpoint_path of None serves randomly initialized weights (load testing)
+        with self._lock:
+            self._loading[name] = {"state": "loading", "checkpoint": checkpoint_path, "config": config_path}
+
+        thread = threading.Thread(
+            target=self._load_and_swap,
+            args=(name, checkpoint_path, config_path),
+            daemon=True,
+        )
+        thread.start()
+
+        if block:
+            thread.join()
+
+        return thread
+
+    def _load_and_swap(self, name: str, checkpoint_path: str, config_path: str) -> None:
+        try:
+            start = time.perf_counter()
+            config = get_configuration(config_path)
+            model = build_model(config, self.tokenizer, cache_pool_size=self.cache_pool_size)
+            if self.bucketing and model.position_encoding == "rotary":
+                raise ValueError("Bucketing is not supported for rotary models, which use the rolling cache")
+            if checkpoint_path is not None:
+                model.load_state_dict(load_checkpoint(checkpoint_path, map_location=self.device))
+            model.to(self.device)
+            model.eval()
+
+            entry = ModelEntry(name, model, checkpoint_path, config_path)
+            entry.load_seconds = time.perf_counter() - start
+
+            # Build and warm every bucket before the model can serve requests
+            start = time.perf_counter()
+            if self.bucketing:
+                model.bucketed_forward = BucketedForward(model, self.buckets, self.bucketing)
+                entry.bucket_warmup_seconds = model.bucketed_forward.warmup()
+
+            # Warm up with the same call the /predict endpoint makes
+            with torch.no_grad():
+                model.predict(self.tokenizer.bos_token, stop_at_next_move=True, temperature=0.2)
+            entry.warmup_seconds = time.perf_counter() - start
+        except Exception as e:
+            print(f"Error loading model '{name}': {e}")
+            with self._lock:
+                self._loading[name]["state"] = "failed"
+                self._loading[name]["error"] = str(e)
+            return
+
+        start = time.perf_counter()
+        with self._lock:
+            old_entry = self._models.get(name)
+            self._models[name] = entry
+            self._loading.pop(name, None)
+        entry.swap_seconds = time.perf_counter() - start
+
+        # Drop our reference, in-flight requests still hold theirs
+        del old_entry
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+        print(f"Model '{name}' ready ({entry.load_seconds:.2f}s load, {entry.warmup_seconds:.2f}s warmup).")
+
+    def is_ready(self) -> bool:
+        with self._lock:
+            return self.default in self._models
+
+    def get(self, name: str = None) -> ModelEntry:
+        with self._lock:
+            return self._models[name or self.default]
+
+    def unload(self, name: str) -> bool:
+        with self._lock:
+            entry = self._models.pop(name, None)
+
+        if entry is None:
+            return False
+
+        del entry
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+        return True
+
+    def status(self) -> dict:
+        with self._lock:
+            models = {name: entry.status() for name, entry in self._models.items()}
+            loading = {name: dict(state) for name, state in self._loading.items()}
+
+        status = {
+            "default": self.default,
+            "device": str(self.device),
+            "bucketing": self.bucketing,
+            "models": models,
+            "loading": loading,
+            "total_model_memory_mb": sum(m["memory_mb"] for m in models.values()),
+            "total_cache_pool_mb": sum(m["cache_pool_mb"] for m in models.values()),
+        }
+
+        if self.device.type == "cuda":
+            status["cuda_allocated_mb"] = torch.cuda.memory_allocated(self.device) / 2 ** 20
+            status["cuda_reserved_mb"] = torch.cuda.memory_reserved(self.device) / 2 ** 20
+
+        return status
@@ -0,0 +1,197 @@
+import copy
+import math
+import threading
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def rotate_half(x: torch.Tensor) -> torch.Tensor:
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+
+class RollingKVCache:
+    """
+    Keys and values of the last `window` tokens for every layer. Keys are stored
+    already rotated at their absolute position, so attention only depends on
+    relative distances and old entries stay valid as the window slides.
+    """
+
+    def __init__(self, num_layers: int, window: int):
+        self.window = window
+        self.keys = [None] * num_layers
+        self.values = [None] * num_layers
+        self.positions = None
+        self.length = 0
+
+        # Token ids consumed so far, to reuse the cache for a game that continues
+        self.tokens = []
+
+    def memory_bytes(self) -> int:
+        tensors = [t for t in self.keys + self.values if t is not None]
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def snapshot(self) -> tuple:
+        # Cached tensors are replaced, never modified in place, so references are enough
+        return list(self.keys), list(self.values), self.positions, self.length, len(self.tokens)
+
+    def restore(self, state: tuple) -> None:
+        # Drops the tokens consumed since snapshot(), e.g. rejected speculative drafts
+        keys, values, self.positions, self.length, num_tokens = state
+        self.keys, self.values = list(keys), list(values)
+        del self.tokens[num_tokens:]
+
+    def advance(self, positions: torch.Tensor) -> None:
+        # Called once all layers have appended the new tokens
+        if self.positions is None:
+            self.positions = positions
+        else:
+            self.positions = torch.cat((self.positions, positions))
+        self.length += positions.size(0)
+
+        # Drop whatever falls out of the attention window
+        if self.positions.size(0) > self.window:
+            self.positions = self.positions[-self.window:]
+            self.keys = [k[:, :, -self.window:] for k in self.keys]
+            self.values = [v[:, :, -self.window:] for v in self.values]
+
+
+class CachePool:
+    """
+    Keeps the rolling caches of recent games so that a request continuing one of
+    them (the same moves plus new ones) only runs the new tokens. A cache is
+    removed while in use, so concurrent requests never share one.
+    """
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self._caches = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, tokens: list):
+        with self._lock:
+            best_key = None
+            for key in self._caches:
+                if len(key) < len(tokens) and list(key) == tokens[:len(key)]:
+                    if best_key is None or len(key) > len(best_key):
+                        best_key = key
+            return self._caches.pop(best_key) if best_key is not None else None
+
+    def put(self, cache: RollingKVCache) -> None:
+        with self._lock:
+            self._caches[tuple(cache.tokens)] = cache
+            while len(self._caches) > self.max_size:
+                self._caches.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._caches)
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(cache.memory_bytes() for cache in self._caches.values())
+
+
+class RotaryEncoderLayer(nn.Module):
+    """
+    Pre-norm encoder layer with rotary position embeddings applied to queries
+    and keys. Parameter names match nn.TransformerEncoderLayer, so checkpoints
+    trained with the sinusoidal encoding load directly before fine-tuning.
+    """
+
+    def __init__(self, dim_model, num_heads, d_hid, dropout_p, base=10000.0):
+        super().__init__()
+        assert dim_model % num_heads == 0, "dim_model must be divisible by num_heads"
+
+        self.num_heads = num_heads
+        self.head_dim = dim_model // num_heads
+
+        # Only used as a container for in_proj_* and out_proj
+        self.self_attn = nn.MultiheadAttention(dim_model, num_heads, dropout=dropout_p)
+        self.attn_dropout_p = dropout_p
+
+        self.linear1 = nn.Linear(dim_model, d_hid)
+        self.dropout = nn.Dropout(dropout_p)
+        self.linear2 = nn.Linear(d_hid, dim_model)
+
+        self.norm1 = nn.LayerNorm(dim_model)
+        self.norm2 = nn.LayerNorm(dim_model)
+        self.dropout1 = nn.Dropout(dropout_p)
+        self.dropout2 = nn.Dropout(dropout_p)
+
+        inv_freq = 1.0 / (base ** (torch.arange(0, self.head_dim, 2).float() / self.head_dim))
+        self.register_buffer("inv_freq", inv_freq, persistent=False)
+
+    def _rotate(self, x: torch.Tensor, positions: torch.Tensor) -> torch.Tensor:
+        # x: (batch_size, num_heads, sequence length, head_dim)
+        freqs = positions.to(self.inv_freq.dtype)[:, None] * self.inv_freq[None, :]
+        angles = torch.cat((freqs, freqs), dim=-1)
+        return x * angles.cos() + rotate_half(x) * angles.sin()
+
+    def _split_heads(self, x: torch.Tensor) -> torch.Tensor:
+        # (sequence length, batch_size, dim_model) -> (batch_size, num_heads, sequence length, head_dim)
+        length, batch_size, _ = x.shape
+        return x.view(length, batch_size, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+
+    def _attention(self, x, positions, attn_mask=None, key_padding_mask=None, cache=None, index=0):
+        q, k, v = F.linear(x, self.self_attn.in_proj_weight, self.self_attn.in_proj_bias).chunk(3, dim=-1)
+        q = self._rotate(self._split_heads(q), positions)
+        k = self._rotate(self._split_heads(k), positions)
+        v = self._split_heads(v)
+
+        if cache is not None:
+            if cache.keys[index] is not None:
+                k = torch.cat((cache.keys[index], k), dim=2)
+                v = torch.cat((cache.values[index], v), dim=2)
+                key_positions = torch.cat((cache.positions, positions))
+            else:
+                key_positions = positions
+            cache.keys[index], cache.values[index] = k, v
+
+            # Causal and limited to the window the model was trained with
+            distance = positions[:, None] - key_positions[None, :]
+            attn_mask = (distance < 0) | (distance > cache.window)
+
+        scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.head_dim)
+
+        if attn_mask is not None:
+            if attn_mask.dtype == torch.bool:
+                scores = scores.masked_fill(attn_mask, float("-inf"))
+            else:
+                scores = scores + attn_mask
+        if key_padding_mask is not None:
+            scores = scores.masked_fill(key_padding_mask[:, None, None, :].bool(), float("-inf"))
+
+        weights = F.dropout(F.softmax(scores, dim=-1), p=self.attn_dropout_p, training=self.training)
+        out = torch.matmul(weights, v)
+
+        # (batch_size, num_heads, sequence length, head_dim) -> (sequence length, batch_size, dim_model)
+        batch_size, _, length, _ = out.shape
+        out = out.permute(2, 0, 1, 3).reshape(length, batch_size, -1)
+        return self.self_attn.out_proj(out)
+
+    def forward(self, src, src_mask=None, src_key_padding_mask=None, positions=None, cache=None, index=0):
+        if positions is None:
+            positions = torch.arange(src.size(0), device=src.device)
+
+        x = src
+        x = x + self.dropout1(self._attention(self.norm1(x), positions, src_mask, src_key_padding_mask,
+                                              cache, index))
+        x = x + self.dropout2(self.linear2(self.dropout(F.gelu(self.linear1(self.norm2(x))))))
+        return x
+
+
+class RotaryEncoder(nn.Module):
+    # Drop-in for nn.TransformerEncoder (same "layers.N." parameter names)
+    def __init__(self, encoder_layer: RotaryEncoderLayer, num_layers: int):
+        super().__init__()
+        self.layers = nn.ModuleList([copy.deepcopy(encoder_layer) for _ in range(num_layers)])
+        self.norm = None
+
+    def forward(self, src, mask=None, src_key_padding_mask=None):
+        for layer in self.layers:
+            src = layer(src, mask, src_key_padding_mask)
+        return src
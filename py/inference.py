@@ -1,12 +1,14 @@
 """
 Script for playing chess against the ChessMate engine.
 The human player always plays as white.
+Finished games are kept in the game store for later training.
 """
 
 import argparse
 import torch
 from chessutils.configuration import get_configuration
-from chessutils.model import Transformer
+from chessutils.gamestore import GameStore
+from chessutils.model import build_model, load_checkpoint
 from chessutils.tokenizer import Tokenizer
 import os
 import re
@@ -42,20 +44,24 @@ def _parse_args():
                         help='Path to the tokenizer vocabulary file')
     parser.add_argument('--log_file', type=str, default="game_log.txt",
                         help='File to log moves of the game')
+    parser.add_argument('--exit_threshold', type=float, default=None,
+                        help='Confidence threshold for early exit (requires model.exit_layers)')
+    parser.add_argument('--game_store', type=str, default="games",
+                        help='Directory of the game record store (empty to disable)')
 
     return parser.parse_args()
 
 
-def log_move(log_file, move):
+def write_game_log(log_file, moves):
     """
-    Logs each move to a specified file.
+    Writes the logged moves of the game to a specified file at once.
 
     Args:
         log_file (str): Path to the log file.
-        move (str): Chess move to log.
+        moves (list): Log lines of the moves played.
     """
     with open(log_file, "a") as file:
-        file.write(f"{move}\n")
+        file.writelines(f"{move}\n" for move in moves)
 
 
 def is_valid_move(move):
@@ -87,18 +93,9 @@ def main(args) -> None:
 
         # Initialize model and set device (GPU if available, otherwise CPU)
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        model = Transformer(
-            tokenizer=tokenizer,
-            num_tokens=tokenizer.vocab_size(),
-            dim_model=config["model"]["dim_model"],
-            d_hid=config["model"]["d_hid"],
-            num_heads=config["model"]["num_heads"],
-            num_layers=config["model"]["num_layers"],
-            dropout_p=config["model"]["dropout_p"],
-            n_positions=config["model"]["n_positions"],
-        )
+        model = build_model(config, tokenizer)
         try:
-            model.load_state_dict(torch.load(args.load_model, map_location=device))
+            model.load_state_dict(load_checkpoint(args.load_model, map_location=device))
             model.eval()  # Set model to evaluation mode
             model.to(device)
             print("Model loaded successfully.")
@@ -106,6 +103,10 @@ def main(args) -> None:
             print(f"Error loading model: {e}")
             return
 
+    if args.exit_threshold is not None and model.position_encoding == "rotary":
+        print("--exit_threshold is not supported with rotary models.")
+        return
+
     # Prepare game log and initial instructions
     if os.path.exists(args.log_file):
         os.remove(args.log_file)  # Clear previous log
@@ -119,9 +120,13 @@ def main(args) -> None:
 
     input_string = "<bos>"  # Start of game token
     boards = [input_string]  # Stack to store game states
+    game_log = []  # Moves are logged in memory and written when the game ends
+
+    # Rotary models keep a rolling cache and can play past n_positions
+    unbounded = config["model"].get("position_encoding") == "rotary"
 
     # Main game loop
-    while (len(input_string.split(" ")) < config["model"]["n_positions"]
+    while ((unbounded or len(input_string.split(" ")) < config["model"]["n_positions"])
            and input_string.split(" ")[-1] != tokenizer.eos_token):
         
         next_move = input("WHITE MOVE: ")
@@ -145,7 +150,7 @@ def main(args) -> None:
         input_string += " " + next_move
 
         # Log human's move
-        log_move(args.log_file, f"White: {next_move}")
+        game_log.append(f"White: {next_move}")
 
         try:
             # Engine predicts next move for black
@@ -154,13 +159,14 @@ def main(args) -> None:
                     input_string,
                     stop_at_next_move=True,
                     temperature=0.2,
+                    exit_threshold=args.exit_threshold,
                 )
             boards.append(input_string)
             black_move = input_string.split(" ")[-1]
             print("BLACK MOVE:", black_move)
 
             # Log engine's move
-            log_move(args.log_file, f"Black: {black_move}")
+            game_log.append(f"Black: {black_move}")
 
         except ValueError:
             input_string = prev_input_string  # Rollback state on invalid move
@@ -171,6 +177,14 @@ def main(args) -> None:
     print("--- Final board ---")
     print(input_string)
 
+    write_game_log(args.log_file, game_log)
+
+    # Keep the game for later training
+    if args.game_store:
+        store = GameStore(args.game_store)
+        store.record(input_string)
+        store.close()
+
 
 if __name__ == "__main__":
     args = _parse_args()
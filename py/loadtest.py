@@ -0,0 +1,258 @@
+"""
+Load generator for the CheckMate predict server.
+Simulates concurrent players that follow the request pattern of the React
+ChessBoard: after every human move, the whole game so far is posted to
+/predict and the engine's reply is played on the board. Human moves are random
+legal moves chosen with python-chess after a configurable think time. When the
+engine surrenders (e.g. a randomly initialized model finds no legal move), a
+random legal reply is played for it so requests still cover long games.
+Reports throughput, latency percentiles, error rate, surrenders and plies per
+game per concurrency level.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import chess
+
+
+def _parse_args():
+    """
+    Parse command-line arguments for the target server, concurrency levels and player behaviour.
+    """
+    parser = argparse.ArgumentParser(description='CheckMate load testing parser')
+
+    parser.add_argument('--url', type=str, default="http://127.0.0.1:5000",
+                        help='Base URL of the predict server')
+    parser.add_argument('--start_server', action='store_true',
+                        help='Start play.py with a randomly initialized model for the test (fully offline)')
+    parser.add_argument('--config', type=str, default="configs/default.yaml",
+                        help='Configuration file (YAML format) of the server started with --start_server')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help='Numbers of concurrent players to test')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='Seconds spent at each concurrency level')
+    parser.add_argument('--think_time', type=float, nargs=2, default=[0.5, 2.0], metavar=('MIN', 'MAX'),
+                        help='Range of seconds a player thinks before each move')
+    parser.add_argument('--max_plies', type=int, default=80,
+                        help='Players start a new game after this many plies')
+    parser.add_argument('--model', type=str, default=None,
+                        help='Name of the served model to request (default model if omitted)')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='Request timeout in seconds')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Optional TSV file for the report')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed of the simulated players')
+
+    return parser.parse_args()
+
+
+def _post(url, payload, timeout) -> dict:
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def wait_until_ready(url, timeout=600.0, server=None) -> None:
+    """
+    Polls /health until the server reports ready, failing fast if the
+    `server` process started for the test exits meanwhile.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"The server exited with code {server.returncode} before becoming ready")
+        try:
+            with urllib.request.urlopen(url + "/health", timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"Server at {url} did not become ready")
+
+
+class Player(threading.Thread):
+    """
+    One simulated human playing white against the engine until `stop` is set.
+    Every request is recorded as (latency in seconds, success), and every
+    finished game as its number of plies.
+    """
+
+    def __init__(self, args, stop: threading.Event, rng: random.Random):
+        super().__init__(daemon=True)
+        self.args = args
+        self.stop = stop
+        self.rng = rng
+        self.results = []
+        self.plies = []
+        self.surrenders = 0
+
+    def _think(self) -> None:
+        self.stop.wait(self.rng.uniform(*self.args.think_time))
+
+    def run(self) -> None:
+        while not self.stop.is_set():
+            self.plies.append(self.play_game())
+
+    def _play_random(self, board, moves) -> None:
+        move = self.rng.choice(list(board.legal_moves))
+        moves.append(board.san(move))
+        board.push(move)
+
+    def play_game(self) -> int:
+        """
+        Plays one game and returns its number of plies.
+        """
+        board = chess.Board()
+        moves = []
+
+        while not self.stop.is_set() and not board.is_game_over() and len(moves) < self.args.max_plies:
+            self._think()
+            if self.stop.is_set():
+                break
+
+            self._play_random(board, moves)
+            if board.is_game_over():
+                break
+
+            # Same payload as ChessBoard.makeEngineMove: the whole game, without move numbers
+            payload = {"input_moves": " ".join(moves)}
+            if self.args.model:
+                payload["model"] = self.args.model
+
+            start = time.perf_counter()
+            try:
+                response = _post(self.args.url + "/predict", payload, self.args.timeout)
+                success = bool(response.get("success"))
+            except (urllib.error.URLError, ConnectionError, TimeoutError, ValueError):
+                response, success = None, False
+            self.results.append((time.perf_counter() - start, success))
+
+            if not success:
+                break
+
+            # The reply is the engine move, possibly followed by <eos> (checkmate), or only <eos> (surrender)
+            reply = [token for token in response["moves"].split(" ")[len(moves):] if token != "<eos>"]
+            if not reply:
+                # Keep the game going so later requests still have mid-game and long inputs
+                self.surrenders += 1
+                self._play_random(board, moves)
+                continue
+
+            try:
+                board.push_san(reply[0])
+                moves.append(reply[0])
+            except ValueError:
+                # The engine answered with an illegal move: count it and start over
+                self.results[-1] = (self.results[-1][0], False)
+                break
+
+        return len(moves)
+
+
+def _percentile(sorted_values, q) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_level(args, concurrency, rng) -> dict:
+    """
+    Runs `concurrency` players for args.duration seconds and summarizes their requests.
+    """
+    stop = threading.Event()
+    players = [Player(args, stop, random.Random(rng.random())) for _ in range(concurrency)]
+
+    start = time.perf_counter()
+    for player in players:
+        player.start()
+    time.sleep(args.duration)
+    stop.set()
+    for player in players:
+        player.join()
+    elapsed = time.perf_counter() - start
+
+    results = [result for player in players for result in player.results]
+    latencies = sorted(latency for latency, success in results if success)
+    errors = sum(1 for _, success in results if not success)
+
+    plies = [p for player in players for p in player.plies]
+    surrenders = sum(player.surrenders for player in players)
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "games": len(plies),
+        "plies_per_game": sum(plies) / len(plies) if plies else 0.0,
+        "max_plies": max(plies, default=0),
+        "surrender_rate": surrenders / len(results) if results else 0.0,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": 1000 * _percentile(latencies, 50),
+        "p95_ms": 1000 * _percentile(latencies, 95),
+        "p99_ms": 1000 * _percentile(latencies, 99),
+        "error_rate": errors / len(results) if results else 0.0,
+    }
+
+
+def write_report(rows, output=None) -> None:
+    """
+    Prints the report and optionally writes it to a TSV file.
+    """
+    columns = ["concurrency", "requests", "games", "plies_per_game", "max_plies", "surrender_rate",
+               "throughput", "p50_ms", "p95_ms", "p99_ms", "error_rate"]
+    lines = ["\t".join(columns)]
+    for row in rows:
+        lines.append("\t".join(str(row[c]) if isinstance(row[c], int) else f"{row[c]:.3f}" for c in columns))
+
+    print("\n -------- LOAD TEST REPORT --------\n")
+    print("\n".join(lines))
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def main(args) -> None:
+    """
+    Optionally starts a random-init server, then runs every concurrency level.
+    """
+    server = None
+    if args.start_server:
+        port = urllib.parse.urlsplit(args.url).port or 5000
+        server = subprocess.Popen(
+            [sys.executable, "play.py", "--random_init", "--config", args.config,
+             "--port", str(port), "--game_store", ""],
+            cwd=os.path.dirname(os.path.realpath(__file__)),
+        )
+
+    try:
+        wait_until_ready(args.url, server=server)
+        rng = random.Random(args.seed)
+        rows = []
+        for concurrency in args.concurrency:
+            print(f"Running {concurrency} concurrent players for {args.duration:.0f}s...")
+            rows.append(run_level(args, concurrency, rng))
+        write_report(rows, args.output)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    main(args)
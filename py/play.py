@@ -1,12 +1,20 @@
 """
 Flask API for interacting with the CheckMate engine.
 This server provides an endpoint to predict the next move given the sequence of moves played.
+Several named models can be served at once and hot-swapped through the admin endpoints
+(opt-in with --admin, not exposed to browsers through CORS).
+Session games can opt into pondering, which precomputes replies while the human thinks.
+Finished games are recorded in the background to the game store for later training.
 """
 
+import atexit
 import argparse
+from contextlib import nullcontext
 import torch
-from chessutils.configuration import get_configuration
-from chessutils.model import Transformer
+from chessutils.bucketing import BUCKETING_MODES
+from chessutils.gamestore import GameStore
+from chessutils.ponder import Ponderer
+from chessutils.registry import ModelRegistry
 from chessutils.tokenizer import Tokenizer
 from flask import Flask, request, jsonify, make_response
 import os
@@ -23,6 +31,37 @@ def _parse_args():
                         help='Path to the configuration file (YAML format)')
     parser.add_argument('--tokenizer', type=str, default="vocab/vocab.txt",
                         help='Path to the tokenizer vocabulary file')
+    parser.add_argument('--exit_threshold', type=float, default=None,
+                        help='Confidence threshold for early exit (requires model.exit_layers)')
+    parser.add_argument('--model', type=str, nargs=3, action='append', default=[],
+                        metavar=('NAME', 'CHECKPOINT', 'CONFIG'),
+                        help='Additional named model to serve, loaded in the background (repeatable)')
+    parser.add_argument('--bucketing', type=str, default=None, choices=BUCKETING_MODES,
+                        help='Pad inputs to fixed length buckets and run one eager/traced/compiled graph per bucket')
+    parser.add_argument('--buckets', type=int, nargs='+', default=None,
+                        help='Bucket lengths (defaults to multiples of 16 up to n_positions)')
+    parser.add_argument('--cache_pool_size', type=int, default=64,
+                        help='Rolling attention caches kept per rotary model for continuing games')
+    parser.add_argument('--ponder', action='store_true',
+                        help='Allow session games to opt into pondering on the human\'s likely replies')
+    parser.add_argument('--ponder_candidates', type=int, default=3,
+                        help='Number of likely human moves answered ahead of time per session')
+    parser.add_argument('--ponder_budget', type=float, default=2.0,
+                        help='Maximum seconds spent pondering after each engine move')
+    parser.add_argument('--ponder_workers', type=int, default=1,
+                        help='Background threads shared by all pondering sessions')
+    parser.add_argument('--game_store', type=str, default="games",
+                        help='Directory of the game record store (empty to disable)')
+    parser.add_argument('--random_init', action='store_true',
+                        help='Serve a randomly initialized default model instead of --load_model (load testing)')
+    parser.add_argument('--admin', action='store_true',
+                        help='Enable the /admin endpoints (model hot-swap, statistics) for trusted clients')
+    parser.add_argument('--model_dir', type=str, default="model",
+                        help='Directory that checkpoints loaded through /admin/models must be in')
+    parser.add_argument('--host', type=str, default="127.0.0.1",
+                        help='Host the server listens on')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='Port the server listens on')
 
     return parser.parse_args()
 
@@ -30,33 +69,35 @@ def _parse_args():
 app = Flask(__name__)
 app.config['CORS_HEADERS'] = 'Content-Type'
 
-# Parse arguments and load configuration, tokenizer, and model
+# Parse arguments and load tokenizer and models
 args = _parse_args()
-config = get_configuration(args.config)
 tokenizer = Tokenizer(args.tokenizer)
 
+# Early exit runs variable-length eager graphs, which would silently bypass the buckets
+if args.bucketing and args.exit_threshold is not None:
+    raise SystemExit("--exit_threshold cannot be combined with --bucketing.")
+
 # Configure device for model inference (GPU if available, else CPU)
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = Transformer(
-    tokenizer=tokenizer,
-    num_tokens=tokenizer.vocab_size(),
-    dim_model=config["model"]["dim_model"],
-    d_hid=config["model"]["d_hid"],
-    num_heads=config["model"]["num_heads"],
-    num_layers=config["model"]["num_layers"],
-    dropout_p=config["model"]["dropout_p"],
-    n_positions=config["model"]["n_positions"],
-)
-
-# Load model weights onto the appropriate device
-try:
-    print("Loading model...")
-    model.load_state_dict(torch.load(args.load_model, map_location=device))
-    model.to(device)
-    model.eval()  # Set model to evaluation mode
-    print("Model loaded successfully.")
-except Exception as e:
-    print(f"Error loading model: {e}")
+registry = ModelRegistry(tokenizer, device, bucketing=args.bucketing, buckets=args.buckets,
+                         cache_pool_size=args.cache_pool_size)
+
+# The default model is ready before serving, the others are swapped in when warm
+print("Loading model...")
+registry.load(registry.default, None if args.random_init else args.load_model, args.config, block=True)
+if not registry.is_ready():
+    raise SystemExit("The default model could not be loaded.")
+if args.exit_threshold is not None and registry.get().model.position_encoding == "rotary":
+    raise SystemExit("--exit_threshold is not supported with rotary models.")
+for name, checkpoint_path, config_path in args.model:
+    registry.load(name, checkpoint_path, config_path)
+
+ponderer = Ponderer(args.ponder_candidates, args.ponder_budget, workers=args.ponder_workers) if args.ponder else None
+
+# Served games are batched to disk by a background writer
+game_store = GameStore(args.game_store) if args.game_store else None
+if game_store is not None:
+    atexit.register(game_store.close)
 
 def _build_cors_preflight_response():
     """
@@ -64,8 +105,8 @@ def _build_cors_preflight_response():
     """
     response = make_response()
     response.headers.add("Access-Control-Allow-Origin", "*")
-    response.headers.add('Access-Control-Allow-Headers', "*")
-    response.headers.add('Access-Control-Allow-Methods', "*")
+    response.headers.add('Access-Control-Allow-Headers', "Content-Type")
+    response.headers.add('Access-Control-Allow-Methods', "POST, OPTIONS")
     return response
 
 def _corsify_actual_response(response):
@@ -75,11 +116,25 @@ def _corsify_actual_response(response):
     response.headers.add("Access-Control-Allow-Origin", "*")
     return response
 
+def _admin_disabled():
+    """
+    Response of the admin endpoints when the server runs without --admin.
+    """
+    return make_response(jsonify({'success': False, 'message': 'Admin endpoints are disabled.'}), 404)
+
+def _inside(path, directory):
+    """
+    Whether `path` resolves to a file inside `directory` (symlinks and '..' included).
+    """
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([os.path.realpath(path), directory]) == directory
+
 @app.route('/predict', methods=['POST', 'OPTIONS'])
 def predict():
     """
     Endpoint to predict the next move in a chess game.
-    Accepts a JSON request with 'input_moves' (PGN string of moves played so far).
+    Accepts a JSON request with 'input_moves' (PGN string of moves played so far),
+    and optionally 'model', 'session_id' and 'ponder' (precompute the next reply).
     """
     if request.method == "OPTIONS":  # Handle CORS preflight request
         return _build_cors_preflight_response()
@@ -91,17 +146,33 @@ def predict():
             response = {'success': False, 'message': 'Bad request'}
             return _corsify_actual_response(jsonify(response))
 
+        # Pick the requested model, or the default one
+        try:
+            entry = registry.get(request_data.get('model'))
+        except KeyError:
+            response = {'success': False, 'message': 'Unknown model.'}
+            return _corsify_actual_response(jsonify(response))
+
         # Prepare input moves for model prediction
         input_moves = tokenizer.bos_token + " " + request_data['input_moves'].strip()
 
+        session_id = request_data.get('session_id')
+        predict_kwargs = {'temperature': 0.2, 'exit_threshold': args.exit_threshold}
+
+        # The real move arrived: stop pondering and use a precomputed reply if there is one
+        output_moves = None
+        if ponderer is not None and session_id is not None:
+            output_moves = ponderer.lookup(session_id, entry, input_moves)
+
         try:
             # Perform inference without gradient computation to save memory
-            with torch.no_grad():
-                output_moves = model.predict(
-                    input_moves,
-                    stop_at_next_move=True,
-                    temperature=0.2,
-                )
+            if output_moves is None:
+                with torch.no_grad(), (ponderer.foreground() if ponderer is not None else nullcontext()):
+                    output_moves = entry.model.predict(
+                        input_moves,
+                        stop_at_next_move=True,
+                        **predict_kwargs,
+                    )
         except ValueError:
             # Handle illegal moves gracefully
             response = {'success': False, 'message': "Illegal move."}
@@ -111,10 +182,101 @@ def predict():
             response = {'success': False, 'message': "Unhandled error."}
             return _corsify_actual_response(jsonify(response))
 
+        # A checkmate or a surrender ends the game
+        if game_store is not None and output_moves.endswith(tokenizer.eos_token):
+            game_store.record(output_moves)
+
+        # Ponder on the human's likely replies while they think
+        if (ponderer is not None and session_id is not None and request_data.get('ponder')
+                and not output_moves.endswith(tokenizer.eos_token)):
+            ponderer.start(session_id, entry, output_moves, **predict_kwargs)
+
         # Process and format the output
         output_moves = output_moves.replace("<bos> ", "")
         response = {'success': True, 'moves': output_moves}
         return _corsify_actual_response(jsonify(response))
 
+@app.route('/games', methods=['POST', 'OPTIONS'])
+def record_game():
+    """
+    Records a game that ended on the client side (draw, resignation, abandoned...).
+    Accepts a JSON request with 'moves' (PGN string of all moves played).
+    """
+    if request.method == "OPTIONS":  # Handle CORS preflight request
+        return _build_cors_preflight_response()
+
+    # Any content type: the UI sends games with navigator.sendBeacon (text/plain) when the page closes
+    request_data = request.get_json(force=True, silent=True)
+    if request_data is None or 'moves' not in request_data:
+        response = {'success': False, 'message': 'Bad request'}
+        return _corsify_actual_response(jsonify(response))
+
+    if game_store is None:
+        response = {'success': False, 'message': 'The game store is disabled.'}
+        return _corsify_actual_response(jsonify(response))
+
+    game_store.record(request_data['moves'])
+    return _corsify_actual_response(jsonify({'success': True}))
+
+@app.route('/health', methods=['GET'])
+def health():
+    """
+    Readiness probe: 200 once the default model is loaded and warm, 503 before.
+    """
+    if registry.is_ready():
+        return _corsify_actual_response(jsonify({'success': True, 'ready': True}))
+    return _corsify_actual_response(make_response(jsonify({'success': False, 'ready': False}), 503))
+
+# Admin endpoints get no CORS headers: browsers on other origins cannot call them
+@app.route('/admin/models', methods=['GET', 'POST'])
+def admin_models():
+    """
+    GET returns the served models with their memory use and load/warmup/swap times.
+    POST with JSON 'name', 'checkpoint' and 'config' loads a model in the background
+    and atomically swaps it in (replacing any model with the same name) once warm.
+    The checkpoint must be inside --model_dir.
+    """
+    if not args.admin:
+        return _admin_disabled()
+    elif request.method == 'GET':
+        return jsonify(registry.status())
+
+    request_data = request.get_json()
+    if request_data is None or not all(k in request_data for k in ('name', 'checkpoint', 'config')):
+        return jsonify({'success': False, 'message': 'Bad request'})
+
+    if not _inside(request_data['checkpoint'], args.model_dir):
+        return jsonify({'success': False, 'message': f"Checkpoints must be in '{args.model_dir}'."})
+
+    registry.load(request_data['name'], request_data['checkpoint'], request_data['config'])
+    return jsonify({'success': True, 'message': f"Loading model '{request_data['name']}'."})
+
+@app.route('/admin/ponder', methods=['GET'])
+def admin_ponder():
+    """
+    Pondering statistics: hit rate and compute spent on replies that were never used.
+    """
+    if not args.admin:
+        return _admin_disabled()
+    elif ponderer is None:
+        return jsonify({'success': False, 'message': 'Pondering is disabled.'})
+    return jsonify(ponderer.status())
+
+@app.route('/admin/models/<name>', methods=['DELETE'])
+def admin_unload_model(name):
+    """
+    Unloads a served model.
+    """
+    if not args.admin:
+        return _admin_disabled()
+
+    if name == registry.default:
+        response = {'success': False, 'message': 'The default model cannot be unloaded.'}
+    elif registry.unload(name):
+        response = {'success': True, 'message': f"Model '{name}' unloaded."}
+    else:
+        response = {'success': False, 'message': 'Unknown model.'}
+    return jsonify(response)
+
 if __name__ == '__main__':
-    app.run(threaded=True)
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,236 @@
+"""
+Script for running a hyperparameter sweep of the Transformer model.
+The dataset is tokenized once into a memory-mapped file shared by all trials,
+trials run in parallel processes pinned to their own CPU cores, and trials whose
+validation loss is clearly worse than the best one at the same epoch stop early.
+"""
+
+import os
+
+# tqdm reads its TQDM_* defaults when it is imported, so this comes before anything imports it:
+# the trial processes (which import this module too) do not interleave progress bars
+os.environ["TQDM_DISABLE"] = "1"
+
+import time
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from chessutils.configuration import get_configuration
+from chessutils.dataset import PGNDataset, TokenizedDataset
+from chessutils.model import build_model
+from chessutils.tokenizer import Tokenizer
+from train import Trainer
+
+
+def _parse_args():
+    """
+    Parse command-line arguments for the sweep grid, parallelism and early stopping.
+    """
+    parser = argparse.ArgumentParser(description='CheckMate hyperparameter sweep parser')
+
+    parser.add_argument('--configs', type=str, nargs='+', default=["configs/default.yaml"],
+                        help='Configuration files (YAML format) to sweep over')
+    parser.add_argument('--lrs', type=float, nargs='+', default=[0.00025],
+                        help='Learning rates to sweep over')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64],
+                        help='Batch sizes to sweep over')
+    parser.add_argument('--beta1', type=float, default=0.9,
+                        help='Adam optimizer beta1 parameter')
+    parser.add_argument('--epochs', type=int, default=10,
+                        help='Maximum number of epochs per trial')
+    parser.add_argument('--tokenizer', type=str, default="vocab/vocab.txt",
+                        help='Path to the tokenizer vocabulary file')
+    parser.add_argument('--dataset', type=str, default="dataset/processed_data.txt",
+                        help='Path to the processed dataset')
+    parser.add_argument('--tokenized', type=str, default=None,
+                        help='Path of the shared tokenized dataset (defaults to <dataset>.<width>.npy)')
+    parser.add_argument('--parallel', type=int, default=None,
+                        help='Number of trials run at once (defaults to CPU cores / threads per trial)')
+    parser.add_argument('--threads_per_trial', type=int, default=4,
+                        help='CPU threads (and pinned cores) per trial')
+    parser.add_argument('--min_epochs', type=int, default=2,
+                        help='Epochs every trial runs before it can be stopped early')
+    parser.add_argument('--stop_margin', type=float, default=0.1,
+                        help='Stop a trial whose val loss exceeds the best at the same epoch by this fraction')
+    parser.add_argument('--save_dir', type=str, default='./sweep',
+                        help='Directory for the trial checkpoints and the results table')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the train/validation split shared by all trials')
+
+    return parser.parse_args()
+
+
+def _should_stop(val_losses, lock, epoch, val_loss, min_epochs, stop_margin) -> bool:
+    """
+    Records the trial's validation loss for the epoch and tells whether it is
+    clearly worse than the best trial at the same epoch.
+    """
+    with lock:
+        losses = val_losses.get(epoch, [])
+        best = min(losses) if losses else val_loss
+        val_losses[epoch] = losses + [val_loss]
+
+    return epoch + 1 >= min_epochs and val_loss > best * (1 + stop_margin)
+
+
+def run_trial(trial, shared) -> dict:
+    """
+    Trains one trial in its own process and returns its results row.
+    """
+    cores = shared["core_slots"].get()
+    start = time.perf_counter()
+
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+
+        config = get_configuration(trial["config"])
+        tokenizer = Tokenizer(shared["tokenizer"])
+        # Like train.py, rotary models see a new random window of long games every epoch
+        rotary = config["model"].get("position_encoding") == "rotary"
+        data = TokenizedDataset(shared["tokenized"], config["model"]["n_positions"], random_window=rotary)
+
+        train_loader = DataLoader(Subset(data, shared["train_indices"]), batch_size=trial["batch_size"], shuffle=True)
+        val_loader = DataLoader(Subset(data, shared["val_indices"]), batch_size=trial["batch_size"], shuffle=False)
+
+        trainer = Trainer(
+            model=build_model(config, tokenizer),
+            train_loader=train_loader,
+            val_loader=val_loader,
+            loss_fn=torch.nn.NLLLoss(ignore_index=tokenizer.pad_token_index),
+            save_dir=shared["save_dir"],
+            learning_rate=trial["lr"],
+            num_epochs=shared["epochs"],
+            adam_beta=shared["beta1"],
+        )
+
+        best_val_loss, train_loss, epochs_run, stopped_early = np.inf, np.inf, 0, False
+
+        for epoch in range(shared["epochs"]):
+            train_loss = trainer.train_epoch()
+            val_loss = trainer.test_epoch()
+            epochs_run = epoch + 1
+            print(f"Trial {trial['id']} epoch {epochs_run}: train loss {train_loss:.4f}, val loss {val_loss:.4f}")
+
+            if val_loss < best_val_loss:
+                best_val_loss = val_loss
+                torch.save(trainer.model.state_dict(),
+                           os.path.join(shared["save_dir"], f"trial_{trial['id']}.pth"))
+
+            if _should_stop(shared["val_losses"], shared["lock"], epoch, val_loss,
+                            shared["min_epochs"], shared["stop_margin"]):
+                stopped_early = True
+                print(f"Trial {trial['id']} stopped early.")
+                break
+    finally:
+        shared["core_slots"].put(cores)
+
+    return {
+        **trial,
+        "epochs_run": epochs_run,
+        "best_val_loss": float(best_val_loss),
+        "train_loss": float(train_loss),
+        "stopped_early": stopped_early,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _run_trial_star(args):
+    return run_trial(*args)
+
+
+def write_results(results, results_path) -> None:
+    """
+    Prints the results sorted by validation loss and writes them to a TSV file.
+    """
+    columns = ["id", "config", "lr", "batch_size", "epochs_run", "best_val_loss",
+               "train_loss", "stopped_early", "seconds"]
+    results = sorted(results, key=lambda row: row["best_val_loss"])
+
+    print("\n -------- SWEEP RESULTS --------\n")
+    with open(results_path, "w", encoding="utf-8") as f:
+        f.write("\t".join(columns) + "\n")
+        print("\t".join(columns))
+        for row in results:
+            line = "\t".join(str(row[c]) if not isinstance(row[c], float) else f"{row[c]:.6g}" for c in columns)
+            f.write(line + "\n")
+            print(line)
+
+    print(f"\nResults written to {results_path}")
+
+
+def main(args) -> None:
+    """
+    Tokenizes the dataset once, then runs every trial of the grid in a pool of
+    pinned worker processes.
+    """
+    os.makedirs(args.save_dir, exist_ok=True)
+    tokenizer = Tokenizer(args.tokenizer)
+
+    # One shared tokenized copy, cut to each config's n_positions by the trials.
+    # Rotary trials draw random windows from it, so it then holds whole games
+    configs = [get_configuration(path)["model"] for path in args.configs]
+    dataset = PGNDataset(tokenizer, args.dataset)
+    width = max(config["n_positions"] for config in configs)
+    if any(config.get("position_encoding") == "rotary" for config in configs):
+        width = max(width, dataset.max_length())
+
+    tokenized = args.tokenized or f"{args.dataset}.{width}.npy"
+    if not TokenizedDataset.is_current(tokenized, args.dataset, tokenizer, width):
+        print(f"Tokenizing {args.dataset} into {tokenized}...")
+        dataset.n_positions = width
+        TokenizedDataset.write(dataset, tokenized)
+    del dataset
+
+    # Same train/validation split for every trial
+    num_games = len(TokenizedDataset(tokenized))
+    indices = np.random.default_rng(args.seed).permutation(num_games)
+    train_len = int(num_games * 0.8)
+
+    trials = [
+        {"id": i, "config": config, "lr": lr, "batch_size": batch_size}
+        for i, (config, lr, batch_size) in enumerate(itertools.product(args.configs, args.lrs, args.batch_sizes))
+    ]
+
+    # Split the cores into one disjoint, non-empty slot per parallel trial
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    parallel = args.parallel or max(1, len(cores) // args.threads_per_trial)
+    parallel = min(parallel, len(trials), len(cores))
+    slots = [cores[slot * len(cores) // parallel:(slot + 1) * len(cores) // parallel] for slot in range(parallel)]
+    print(f"Running {len(trials)} trials, {parallel} at a time with {len(cores) // parallel}+ threads each.")
+
+    ctx = mp.get_context("spawn")
+    with ctx.Manager() as manager:
+        core_slots = manager.Queue()
+        for slot in slots:
+            core_slots.put(slot)
+
+        shared = {
+            "core_slots": core_slots,
+            "val_losses": manager.dict(),
+            "lock": manager.Lock(),
+            "tokenizer": args.tokenizer,
+            "tokenized": tokenized,
+            "train_indices": indices[:train_len].tolist(),
+            "val_indices": indices[train_len:].tolist(),
+            "save_dir": args.save_dir,
+            "epochs": args.epochs,
+            "beta1": args.beta1,
+            "min_epochs": args.min_epochs,
+            "stop_margin": args.stop_margin,
+        }
+
+        with ctx.Pool(processes=parallel, maxtasksperchild=1) as pool:
+            results = list(pool.imap_unordered(_run_trial_star, [(trial, shared) for trial in trials]))
+
+    write_results(results, os.path.join(args.save_dir, "sweep_results.tsv"))
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    main(args)
@@ -1,19 +1,27 @@
 """
 Script for training the Transformer model on chess game data.
 It defines a Trainer class to handle training and evaluation loops and uses a
-transformer model for move prediction.
+transformer model for move prediction. A DistillationTrainer can additionally
+train a smaller student model on the soft targets of a teacher checkpoint.
+Activation checkpointing and a memory-budgeted batch-size finder allow larger
+batches and longer contexts on the same hardware. An ExitTrainer trains the
+early-exit heads of a frozen model. Sinusoidal checkpoints can be converted to
+rotary position encoding (long games with a rolling cache) by fine-tuning.
 """
 
 import os
+import time
 import argparse
+from contextlib import contextmanager
 from tqdm import tqdm
 import numpy as np
 import torch
+import torch.nn.functional as F
 from torch.utils.data import DataLoader, random_split
 
 from chessutils.configuration import get_configuration
 from chessutils.dataset import PGNDataset
-from chessutils.model import Transformer
+from chessutils.model import build_model, load_checkpoint
 from chessutils.tokenizer import Tokenizer
 
 def _parse_args():
@@ -43,14 +51,254 @@ def _parse_args():
     parser.add_argument('--load_model', type=str, default=None,
                         help='Path to a pre-trained model for resuming training')
 
+    # Distillation: --config describes the student, --teacher_config the teacher
+    parser.add_argument('--teacher_model', type=str, default=None,
+                        help='Path to a teacher checkpoint; enables distillation into the --config model')
+    parser.add_argument('--teacher_config', type=str, default="configs/default.yaml",
+                        help='Configuration file (YAML format) of the teacher model')
+    parser.add_argument('--distill_temperature', type=float, default=2.0,
+                        help='Softmax temperature applied to teacher and student distributions')
+    parser.add_argument('--distill_alpha', type=float, default=0.5,
+                        help='Weight of the soft-target loss (the rest goes to the hard NLL loss)')
+    parser.add_argument('--report_batches', type=int, default=20,
+                        help='Number of validation batches used for the latency/agreement report')
+
+
+    # Memory: recompute layer activations in backward and/or pick the batch size automatically
+    parser.add_argument('--checkpoint_activations', action='store_true',
+                        help='Recompute every encoder layer activation during backward to save memory')
+    parser.add_argument('--memory_budget', type=float, default=None,
+                        help='Memory budget in MB; picks the largest batch size that fits (overrides --batch_size)')
+    parser.add_argument('--max_batch_size', type=int, default=4096,
+                        help='Upper bound for the batch-size finder')
+    parser.add_argument('--loss_chunk_size', type=int, default=None,
+                        help='Compute the output projection and loss this many tokens at a time '
+                             '(never materializes the full vocabulary log-probs)')
+
+    # Early exit: the config must define model.exit_layers
+    parser.add_argument('--train_exits', action='store_true',
+                        help='Train the early-exit heads of the --load_model checkpoint, keeping the rest frozen')
+    parser.add_argument('--exit_thresholds', type=float, nargs='+', default=[0.5, 0.7, 0.9],
+                        help='Confidence thresholds compared in the early-exit report')
+    parser.add_argument('--report_positions', type=int, default=200,
+                        help='Number of validation positions used for the early-exit report')
+
+    # Long games: fine-tune a sinusoidal checkpoint with a rotary config (e.g. configs/rotary.yaml)
+    parser.add_argument('--convert_checkpoint', action='store_true',
+                        help='Load --load_model into a model with a different position encoding and fine-tune it')
+
     return parser.parse_args()
 
+
+@contextmanager
+def _count_saved_tensors(exclude):
+    """
+    Context manager yielding a dict whose "bytes" entry accumulates the size of
+    every distinct tensor saved for backward (parameters in `exclude` are skipped).
+    """
+    seen = set(exclude)
+    counter = {"bytes": 0}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in seen:
+            seen.add(storage.data_ptr())
+            counter["bytes"] += storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        yield counter
+
+
+def training_loss(model, loss_fn, y_input, y_expected, src_mask, pad_mask, loss_chunk_size=None) -> torch.Tensor:
+    """
+    Forward pass + loss. With `loss_chunk_size`, the loss is computed from the
+    encoder output in chunks and the full vocabulary log-probs never exist.
+    """
+    if loss_chunk_size:
+        hidden = model.encode(y_input, src_mask, pad_mask)
+        return model.chunked_nll_loss(hidden, y_expected, loss_chunk_size, loss_fn.ignore_index)
+
+    pred = model(y_input, src_mask, pad_mask)
+    return loss_fn(pred.view(-1, model.tokenizer.vocab_size()), y_expected)
+
+
+def _probe_batch(dataset, batch_size) -> torch.Tensor:
+    """
+    Builds a batch of the requested size, cycling through the dataset if needed.
+    """
+    return torch.stack([dataset[i % len(dataset)] for i in range(batch_size)])
+
+
+def measure_training_step(model, dataset, loss_fn, batch_size, device, repeats=2, loss_chunk_size=None) -> dict:
+    """
+    Runs forward + backward passes for one batch and returns the peak memory in
+    bytes and the throughput in samples per second. On CUDA the peak comes from
+    the allocator statistics (plus the Adam state that the first optimizer step
+    would allocate); on CPU it is estimated from the weights, gradients, Adam
+    state, the activations saved for backward and the gradient of the logits.
+    """
+    model.train()
+    X = _probe_batch(dataset, batch_size).to(device).t().contiguous()
+    y_input, y_expected = X[:-1], X[1:].reshape(-1)
+    src_mask = model.get_src_mask(y_input.size(0)).to(device).bool()
+    pad_mask = model.get_pad_mask(y_input, model.tokenizer.pad_token_index).to(device).bool()
+
+    params = list(model.parameters())
+    param_bytes = sum(p.numel() * p.element_size() for p in params)
+
+    def step():
+        training_loss(model, loss_fn, y_input, y_expected, src_mask, pad_mask, loss_chunk_size).backward()
+
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        step()
+        peak_bytes = torch.cuda.max_memory_allocated(device) + 2 * param_bytes
+    else:
+        exclude = [p.untyped_storage().data_ptr() for p in params]
+        with _count_saved_tensors(exclude) as saved:
+            loss = training_loss(model, loss_fn, y_input, y_expected, src_mask, pad_mask, loss_chunk_size)
+        activation_bytes = saved["bytes"]
+
+        if model.checkpoint_activations:
+            # checkpoint() saves through its own hooks, which hide the layer inputs it keeps alive
+            layer_input = torch.zeros(
+                y_input.size(0), y_input.size(1), model.dim_model, device=device, requires_grad=True
+            )
+            num_layers = len(model.transformer_encoder.layers)
+            activation_bytes += num_layers * layer_input.numel() * layer_input.element_size()
+
+            # Backward recomputes one layer at a time on top of the stored layer inputs
+            with _count_saved_tensors(exclude) as saved_layer:
+                model.transformer_encoder.layers[0](layer_input, src_mask, pad_mask)
+            activation_bytes += saved_layer["bytes"]
+
+        loss.backward()
+
+        # Gradient of the (sequence x batch x vocab) logits, alive during backward. The chunked
+        # loss only has one chunk of recomputed logits and their gradient at a time.
+        rows = y_expected.numel()
+        if loss_chunk_size:
+            rows = 2 * min(rows, loss_chunk_size)
+        logits_grad_bytes = rows * model.tokenizer.vocab_size() * params[0].element_size()
+
+        # Weights + gradients + the two Adam moments
+        peak_bytes = 4 * param_bytes + activation_bytes + logits_grad_bytes
+
+    model.zero_grad(set_to_none=True)
+
+    # Time the remaining repeats, the first one above served as warmup
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+        model.zero_grad(set_to_none=True)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "peak_bytes": peak_bytes,
+        "samples_per_sec": repeats * batch_size / elapsed,
+        "estimated": device.type != "cuda",
+    }
+
+
+def find_batch_size(model, dataset, loss_fn, device, memory_budget, max_batch_size=4096, loss_chunk_size=None):
+    """
+    Finds the largest batch size whose training step fits in `memory_budget`
+    bytes, doubling first and then bisecting. Returns the batch size and its
+    measurement, or (0, None) if not even a single sample fits.
+    """
+    def fits(batch_size):
+        try:
+            result = measure_training_step(
+                model, dataset, loss_fn, batch_size, device, loss_chunk_size=loss_chunk_size
+            )
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise
+            model.zero_grad(set_to_none=True)
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+            return None
+        return result if result["peak_bytes"] <= memory_budget else None
+
+    best_size, best_result = 0, None
+    low, high = 0, None
+    batch_size = 1
+
+    # Exponential search for an upper bound
+    while batch_size <= max_batch_size:
+        result = fits(batch_size)
+        if result is None:
+            high = batch_size
+            break
+        best_size, best_result = batch_size, result
+        low = batch_size
+        batch_size *= 2
+
+    if high is None:
+        return best_size, best_result
+
+    # Bisect between the last batch size that fit and the first one that did not
+    while high - low > 1:
+        mid = (low + high) // 2
+        result = fits(mid)
+        if result is None:
+            high = mid
+        else:
+            low = mid
+            best_size, best_result = mid, result
+
+    return best_size, best_result
+
+
+def memory_report(model, dataset, loss_fn, device, memory_budget, max_batch_size=4096,
+                  loss_chunk_size=None) -> dict:
+    """
+    Runs the batch-size finder with and without activation checkpointing,
+    prints peak memory and throughput for each setting and returns the
+    largest batch size found per setting.
+    """
+    original_setting = model.checkpoint_activations
+    batch_sizes = {}
+
+    print("\n -------- MEMORY REPORT --------\n")
+    print(f"Memory budget: {memory_budget / 2 ** 20:.0f} MB")
+    if device.type != "cuda":
+        print("Peak memory is estimated on CPU (weights, gradients, Adam state, saved activations, logits gradient).")
+    print("checkpointing\tbatch_size\tpeak_mb\tsamples_per_sec")
+
+    for setting in (False, True):
+        model.checkpoint_activations = setting
+        batch_size, result = find_batch_size(
+            model, dataset, loss_fn, device, memory_budget, max_batch_size, loss_chunk_size
+        )
+        batch_sizes[setting] = batch_size
+
+        if result is None:
+            print(f"{setting}\t-\t-\t-")
+        else:
+            estimate = "~" if result["estimated"] else ""
+            print(f"{setting}\t{batch_size}\t{estimate}{result['peak_bytes'] / 2 ** 20:.1f}"
+                  f"\t{result['samples_per_sec']:.1f}")
+
+    model.checkpoint_activations = original_setting
+    return batch_sizes
+
+
 class Trainer:
     """
     Trainer class for handling model training and evaluation.
     """
+    # Prefix of the saved checkpoints
+    checkpoint_name = "checkmate"
+
     def __init__(self, model, train_loader, val_loader, loss_fn, save_dir="./model",
-                 learning_rate=0.001, num_epochs=10, adam_beta=0.5):
+                 learning_rate=0.001, num_epochs=10, adam_beta=0.5, loss_chunk_size=None):
         self.save_dir = save_dir
         self.model = model
         self.train_loader = train_loader
@@ -58,6 +306,7 @@ class Trainer:
         self.lr = learning_rate
         self.loss_fn = loss_fn
         self.num_epochs = num_epochs
+        self.loss_chunk_size = loss_chunk_size
 
         # Optimizer with specified beta parameter
         self.optimizer = torch.optim.Adam(
@@ -69,6 +318,24 @@ class Trainer:
         print(f'Selected device: {self.device}.')
         self.model.to(self.device)
 
+    def _prepare_batch(self, local_batch):
+        """
+        Moves a batch to the device and returns the shifted inputs, the flattened
+        expected outputs and the attention masks.
+        """
+        X = local_batch.to(self.device).t().contiguous()
+
+        # Prepare inputs and expected outputs by shifting
+        y_input = X[:-1]
+        y_expected = X[1:].reshape(-1)
+
+        # Obtain masks for attention mechanism
+        sequence_length = y_input.size(0)
+        src_mask = self.model.get_src_mask(sequence_length).to(self.device).bool()
+        pad_mask = self.model.get_pad_mask(y_input, self.model.tokenizer.pad_token_index).to(self.device).bool()
+
+        return y_input, y_expected, src_mask, pad_mask
+
     def train_epoch(self) -> float:
         """
         Trains the model for one epoch and returns the average training loss.
@@ -77,22 +344,11 @@ class Trainer:
         train_loss = []
 
         for local_batch in tqdm(self.train_loader):
-            X = local_batch.to(self.device).t().contiguous()
-
-            # Prepare inputs and expected outputs by shifting
-            y_input = X[:-1]
-            y_expected = X[1:].reshape(-1)
+            y_input, y_expected, src_mask, pad_mask = self._prepare_batch(local_batch)
 
-            # Obtain masks for attention mechanism
-            sequence_length = y_input.size(0)
-            src_mask = self.model.get_src_mask(sequence_length).to(self.device).bool()
-            pad_mask = self.model.get_pad_mask(y_input, self.model.tokenizer.pad_token_index).to(self.device).bool()
-
-            # Model forward pass
-            pred = self.model(y_input, src_mask, pad_mask)
-
-            # Compute loss
-            loss = self.loss_fn(pred.view(-1, self.model.tokenizer.vocab_size()), y_expected)
+            # Model forward pass and loss
+            loss = training_loss(self.model, self.loss_fn, y_input, y_expected, src_mask, pad_mask,
+                                 self.loss_chunk_size)
             self.optimizer.zero_grad()
             loss.backward()
             self.optimizer.step()
@@ -109,22 +365,11 @@ class Trainer:
 
         with torch.no_grad():
             for local_batch in self.val_loader:
-                X = local_batch.to(self.device).t().contiguous()
-
-                # Prepare inputs and expected outputs by shifting
-                y_input = X[:-1]
-                y_expected = X[1:].reshape(-1)
-
-                # Obtain masks for attention mechanism
-                sequence_length = y_input.size(0)
-                src_mask = self.model.get_src_mask(sequence_length).to(self.device).bool()
-                pad_mask = self.model.get_pad_mask(y_input, self.model.tokenizer.pad_token_index).to(self.device).bool()
-
-                # Model forward pass
-                pred = self.model(y_input, src_mask, pad_mask)
+                y_input, y_expected, src_mask, pad_mask = self._prepare_batch(local_batch)
 
-                # Compute loss
-                loss = self.loss_fn(pred.view(-1, self.model.tokenizer.vocab_size()), y_expected)
+                # Model forward pass and loss
+                loss = training_loss(self.model, self.loss_fn, y_input, y_expected, src_mask, pad_mask,
+                                     self.loss_chunk_size)
                 total_loss += loss.item()
 
             val_loss = total_loss / len(self.val_loader)
@@ -147,10 +392,349 @@ class Trainer:
             # Save the model if it achieves the best validation loss
             if val_loss < best_val_loss:
                 best_val_loss = val_loss
-                torch.save(self.model.state_dict(), os.path.join(self.save_dir, f"checkmate_{epoch + 1}.pth"))
+                torch.save(self.model.state_dict(),
+                           os.path.join(self.save_dir, f"{self.checkpoint_name}_{epoch + 1}.pth"))
 
         # Save the final model
-        torch.save(self.model.state_dict(), os.path.join(self.save_dir, "checkmate.pth"))
+        torch.save(self.model.state_dict(), os.path.join(self.save_dir, f"{self.checkpoint_name}.pth"))
+
+class DistillationTrainer(Trainer):
+    """
+    Trainer that fits a (smaller) student model to the soft targets of a frozen
+    teacher model, blended with the usual hard-target loss.
+    """
+    # Never overwrite the teacher, which usually lives at save_dir/checkmate.pth
+    checkpoint_name = "checkmate_student"
+
+    def __init__(self, model, teacher, train_loader, val_loader, loss_fn, save_dir="./model",
+                 learning_rate=0.001, num_epochs=10, adam_beta=0.5, temperature=2.0, alpha=0.5):
+        super().__init__(model, train_loader, val_loader, loss_fn, save_dir=save_dir,
+                         learning_rate=learning_rate, num_epochs=num_epochs, adam_beta=adam_beta)
+        self.temperature = temperature
+        self.alpha = alpha
+
+        # The teacher only provides targets, it is never updated
+        self.teacher = teacher
+        self.teacher.to(self.device)
+        self.teacher.eval()
+        for param in self.teacher.parameters():
+            param.requires_grad = False
+
+    def distillation_loss(self, student_pred, teacher_pred, y_expected) -> torch.Tensor:
+        """
+        KL divergence between the tempered teacher and student distributions,
+        averaged over the non-padding target positions.
+        """
+        vocab_size = self.model.tokenizer.vocab_size()
+        keep = y_expected != self.model.tokenizer.pad_token_index
+
+        # Re-normalizing log-probabilities divided by T is the same as a softmax over logits / T
+        student_log_probs = F.log_softmax(student_pred.view(-1, vocab_size)[keep] / self.temperature, dim=-1)
+        teacher_log_probs = F.log_softmax(teacher_pred.view(-1, vocab_size)[keep] / self.temperature, dim=-1)
+
+        kl = F.kl_div(student_log_probs, teacher_log_probs, reduction="batchmean", log_target=True)
+
+        # Scale by T^2 so gradient magnitudes do not depend on the temperature
+        return kl * self.temperature ** 2
+
+    def train_epoch(self) -> float:
+        """
+        Trains the student for one epoch and returns the average blended loss.
+        """
+        self.model.train()
+        train_loss = []
+
+        for local_batch in tqdm(self.train_loader):
+            y_input, y_expected, src_mask, pad_mask = self._prepare_batch(local_batch)
+
+            with torch.no_grad():
+                teacher_pred = self.teacher(y_input, src_mask, pad_mask)
+
+            # Student forward pass
+            pred = self.model(y_input, src_mask, pad_mask)
+
+            # Blend soft (teacher) and hard (dataset) targets
+            hard_loss = self.loss_fn(pred.view(-1, self.model.tokenizer.vocab_size()), y_expected)
+            soft_loss = self.distillation_loss(pred, teacher_pred, y_expected)
+            loss = self.alpha * soft_loss + (1 - self.alpha) * hard_loss
+
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+            train_loss.append(loss.detach().cpu().numpy())
+
+        return np.mean(train_loss)
+
+    def report(self, num_batches=20) -> list:
+        """
+        Compares teacher and student on the validation set, returning one row per
+        model with its size, the latency per move and its move agreement with the teacher.
+        """
+        loader = self.val_loader or self.train_loader
+        rows = []
+
+        for name, model in (("teacher", self.teacher), ("student", self.model)):
+            ms_per_move, agreement = _latency_and_agreement(
+                model, self.teacher, loader, self.device, num_batches
+            )
+            rows.append({
+                "model": name,
+                "num_layers": len(model.transformer_encoder.layers),
+                "dim_model": model.dim_model,
+                "parameters": sum(p.numel() for p in model.parameters()),
+                "ms_per_move": ms_per_move,
+                "agreement": agreement,
+            })
+
+        return rows
+
+
+class ExitTrainer(Trainer):
+    """
+    Trainer for the early-exit heads: the backbone and the shared output layer
+    stay frozen and only the exit normalization layers are updated.
+    """
+    # Keeps the base checkpoint, which has no exit_norms.* weights, loadable strictly
+    checkpoint_name = "checkmate_exits"
+
+    def __init__(self, model, train_loader, val_loader, loss_fn, save_dir="./model",
+                 learning_rate=0.001, num_epochs=10, adam_beta=0.5):
+        for name, param in model.named_parameters():
+            param.requires_grad = name.startswith("exit_norms.")
+
+        super().__init__(model, train_loader, val_loader, loss_fn, save_dir=save_dir,
+                         learning_rate=learning_rate, num_epochs=num_epochs, adam_beta=adam_beta)
+
+    def exit_loss(self, y_input, y_expected, src_mask, pad_mask) -> torch.Tensor:
+        """
+        Average NLL loss over all exit heads.
+        """
+        vocab_size = self.model.tokenizer.vocab_size()
+        outputs = self.model.forward_exits(y_input, src_mask, pad_mask)
+        losses = [self.loss_fn(pred.view(-1, vocab_size), y_expected) for _, pred in outputs]
+        return sum(losses) / len(losses)
+
+    def train_epoch(self) -> float:
+        """
+        Trains the exit heads for one epoch and returns the average training loss.
+        """
+        self.model.train()
+        train_loss = []
+
+        for local_batch in tqdm(self.train_loader):
+            y_input, y_expected, src_mask, pad_mask = self._prepare_batch(local_batch)
+
+            loss = self.exit_loss(y_input, y_expected, src_mask, pad_mask)
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+            train_loss.append(loss.detach().cpu().numpy())
+
+        return np.mean(train_loss)
+
+    def test_epoch(self) -> float:
+        """
+        Evaluates the exit heads on the validation set and returns the average loss.
+        """
+        self.model.eval()
+        total_loss = 0.0
+
+        with torch.no_grad():
+            for local_batch in self.val_loader:
+                y_input, y_expected, src_mask, pad_mask = self._prepare_batch(local_batch)
+                total_loss += self.exit_loss(y_input, y_expected, src_mask, pad_mask).item()
+
+            val_loss = total_loss / len(self.val_loader)
+
+        return val_loss
+
+
+def _sample_positions(model, dataset, num_positions) -> list:
+    """
+    Replays random games from the dataset up to a random ply and returns
+    (input_ids, legal_mask) pairs for the positions reached.
+    """
+    import chess
+
+    index_to_token = {index: token for token, index in model.tokenizer.vocab_dict.items()}
+    special = {model.tokenizer.pad_token_index, model.tokenizer.bos_token_index,
+               model.tokenizer.eos_token_index, model.tokenizer.unk_token_index}
+    positions = []
+
+    for i in np.random.permutation(len(dataset))[:num_positions]:
+        tokens = dataset[int(i)].tolist()
+        moves = []
+        for token in tokens[1:]:
+            if token in special:
+                break
+            moves.append(token)
+
+        if not moves:
+            continue
+
+        cut = int(np.random.randint(0, len(moves)))
+        board = chess.Board()
+        try:
+            for token in moves[:cut]:
+                board.push_san(index_to_token[token])
+        except ValueError:
+            continue
+
+        if board.is_game_over():
+            continue
+
+        input_ids = torch.tensor([tokens[:cut + 1]], dtype=torch.long).t()
+        positions.append((input_ids, model.get_legal_mask(board)))
+
+    return positions
+
+
+def early_exit_report(model, dataset, device, thresholds, num_positions=200) -> list:
+    """
+    Compares full-depth inference against early exit at every threshold on
+    random validation positions, printing and returning the average layers
+    executed, latency per move, latency saved and legal move agreement.
+    """
+    model.eval()
+    model.to(device)
+    num_layers = len(model.transformer_encoder.layers)
+    positions = _sample_positions(model, dataset, num_positions)
+
+    def timed(fn):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        result = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        return result, time.perf_counter() - start
+
+    full_moves, full_times = [], []
+    rows = []
+
+    with torch.no_grad():
+        for input_ids, legal_mask in positions:
+            input_ids, legal_mask = input_ids.to(device), legal_mask.to(device)
+            src_mask = model.get_src_mask(input_ids.size(0)).to(device).bool()
+            pad_mask = model.get_pad_mask(input_ids, model.tokenizer.pad_token_index).to(device)
+
+            pred, elapsed = timed(lambda: model(input_ids, src_mask, pad_mask))
+            full_moves.append(pred[-1, 0].masked_fill(~legal_mask, float("-inf")).argmax().item())
+            full_times.append(elapsed)
+
+        full_ms = 1000 * float(np.mean(full_times)) if full_times else 0.0
+        rows.append({"threshold": None, "avg_layers": float(num_layers), "ms_per_move": full_ms,
+                     "ms_saved": 0.0, "agreement": 1.0})
+
+        for threshold in thresholds:
+            layers, times, matches = [], [], 0
+
+            for (input_ids, legal_mask), full_move in zip(positions, full_moves):
+                input_ids, legal_mask = input_ids.to(device), legal_mask.to(device)
+                (log_probs, executed), elapsed = timed(
+                    lambda: model.early_exit_log_probs(input_ids, legal_mask, threshold))
+
+                move = log_probs.masked_fill(~legal_mask, float("-inf")).argmax().item()
+                matches += int(move == full_move)
+                layers.append(executed)
+                times.append(elapsed)
+
+            ms = 1000 * float(np.mean(times)) if times else 0.0
+            rows.append({
+                "threshold": threshold,
+                "avg_layers": float(np.mean(layers)) if layers else 0.0,
+                "ms_per_move": ms,
+                "ms_saved": full_ms - ms,
+                "agreement": matches / len(positions) if positions else 0.0,
+            })
+
+    print("\n -------- EARLY EXIT REPORT --------\n")
+    print(f"Positions: {len(positions)}")
+    print("threshold\tavg_layers\tms_per_move\tms_saved\tagreement")
+    for row in rows:
+        threshold = "full" if row["threshold"] is None else f"{row['threshold']:.2f}"
+        print(f"{threshold}\t{row['avg_layers']:.2f}\t{row['ms_per_move']:.2f}"
+              f"\t{row['ms_saved']:.2f}\t{row['agreement']:.4f}")
+
+    return rows
+
+
+def _latency_and_agreement(model, teacher, loader, device, num_batches, warmup=3, repeats=5):
+    """
+    Measures the mean latency of a single-game forward pass over a truncated game
+    (the cost of predicting one move) and the fraction of non-padding positions
+    where the model's most likely move matches the teacher's. Every position is
+    run `warmup` times untimed, then timed over `repeats` runs.
+    """
+    model.eval()
+    teacher.eval()
+    pad_index = model.tokenizer.pad_token_index
+
+    matches, total = 0, 0
+    timings = []
+
+    with torch.no_grad():
+        for i, local_batch in enumerate(loader):
+            if i >= num_batches:
+                break
+
+            X = local_batch.to(device).t().contiguous()
+            y_input, y_expected = X[:-1], X[1:]
+            src_mask = model.get_src_mask(y_input.size(0)).to(device).bool()
+            pad_mask = model.get_pad_mask(y_input, pad_index).to(device).bool()
+
+            # Move agreement, ignoring padding targets
+            keep = y_expected != pad_index
+            model_moves = model(y_input, src_mask, pad_mask).argmax(dim=-1)
+            teacher_moves = teacher(y_input, src_mask, pad_mask).argmax(dim=-1)
+            matches += (model_moves[keep] == teacher_moves[keep]).sum().item()
+            total += keep.sum().item()
+
+            # Latency: one game at a time, cut at a random ply, as served by /predict
+            game = y_input[:, :1]
+            length = int((game != pad_index).sum().item())
+            cut = int(np.random.randint(1, length + 1)) if length > 0 else 1
+            game = game[:cut]
+            game_src_mask = model.get_src_mask(cut).to(device).bool()
+            game_pad_mask = model.get_pad_mask(game, pad_index).to(device).bool()
+
+            for _ in range(warmup):
+                model(game, game_src_mask, game_pad_mask)
+
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                model(game, game_src_mask, game_pad_mask)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            timings.append((time.perf_counter() - start) / repeats)
+
+    agreement = matches / total if total else 0.0
+    ms_per_move = 1000 * float(np.mean(timings)) if timings else 0.0
+    return ms_per_move, agreement
+
+
+def write_distillation_report(rows, report_path) -> None:
+    """
+    Prints the report and appends it to a TSV file, so runs with different
+    student sizes accumulate into one table.
+    """
+    columns = ["model", "num_layers", "dim_model", "parameters", "ms_per_move", "agreement"]
+    new_file = not os.path.exists(report_path)
+
+    print("\n -------- DISTILLATION REPORT --------\n")
+    print("\t".join(columns))
+    for row in rows:
+        print(f"{row['model']}\t{row['num_layers']}\t{row['dim_model']}\t{row['parameters']}"
+              f"\t{row['ms_per_move']:.2f}\t{row['agreement']:.4f}")
+
+    with open(report_path, "a", encoding="utf-8") as f:
+        if new_file:
+            f.write("\t".join(columns) + "\n")
+        for row in rows:
+            f.write(f"{row['model']}\t{row['num_layers']}\t{row['dim_model']}\t{row['parameters']}"
+                    f"\t{row['ms_per_move']:.4f}\t{row['agreement']:.6f}\n")
 
 def main(args) -> None:
     """
@@ -160,33 +744,95 @@ def main(args) -> None:
     config = get_configuration(args.config)
     tokenizer = Tokenizer(args.tokenizer)
 
-    # Load dataset and create data loaders
-    data = PGNDataset(tokenizer, args.dataset, n_positions=config["model"]["n_positions"])
+    # Load dataset and split it
+    rotary = config["model"].get("position_encoding") == "rotary"
+    data = PGNDataset(tokenizer, args.dataset, n_positions=config["model"]["n_positions"],
+                      random_window=rotary)
     train_len = int(len(data) * 0.8)
     train_data, val_data = random_split(data, [train_len, len(data) - train_len])
 
-    train_loader = DataLoader(train_data, batch_size=args.batch_size, shuffle=True)
-    val_loader = DataLoader(val_data, batch_size=args.batch_size, shuffle=True)
-
     # Initialize the transformer model
-    model = Transformer(
-        tokenizer=tokenizer,
-        num_tokens=tokenizer.vocab_size(),
-        dim_model=config["model"]["dim_model"],
-        d_hid=config["model"]["d_hid"],
-        num_heads=config["model"]["num_heads"],
-        num_layers=config["model"]["num_layers"],
-        dropout_p=config["model"]["dropout_p"],
-        n_positions=config["model"]["n_positions"],
-    )
+    model = build_model(config, tokenizer)
+    model.checkpoint_activations = args.checkpoint_activations
 
     # Load pre-trained model if specified
     if args.load_model:
         print("Loading pre-trained model.")
-        model.load_state_dict(torch.load(args.load_model))
+        # Exit heads are new when training them on top of an existing checkpoint, and the
+        # sinusoidal table is dropped when converting to rotary (all other weights are shared)
+        strict = not (args.train_exits or args.convert_checkpoint)
+        missing, unexpected = model.load_state_dict(load_checkpoint(args.load_model), strict=strict)
+        if missing:
+            print(f"Initialized missing weights: {', '.join(missing)}")
+        if unexpected:
+            print(f"Ignored checkpoint weights: {', '.join(unexpected)}")
 
     loss_fn = torch.nn.NLLLoss(ignore_index=tokenizer.pad_token_index)
 
+    batch_size = args.batch_size
+    if args.memory_budget:
+        # Pick the largest batch that fits the budget for the selected checkpointing setting
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+        model.to(device)
+        batch_sizes = memory_report(
+            model, train_data, loss_fn, device, args.memory_budget * 2 ** 20, args.max_batch_size,
+            args.loss_chunk_size
+        )
+        batch_size = batch_sizes[args.checkpoint_activations]
+        if batch_size == 0:
+            raise RuntimeError("Not even a batch of one sample fits in the memory budget.")
+        print(f"Using batch size {batch_size}.")
+
+    train_loader = DataLoader(train_data, batch_size=batch_size, shuffle=True)
+    val_loader = DataLoader(val_data, batch_size=batch_size, shuffle=True)
+
+    if args.train_exits:
+        assert model.exit_layers, "The configuration must define model.exit_layers"
+
+        trainer = ExitTrainer(
+            model=model,
+            train_loader=train_loader,
+            val_loader=val_loader,
+            loss_fn=loss_fn,
+            save_dir=args.save_dir,
+            learning_rate=args.lr,
+            num_epochs=args.epochs,
+            adam_beta=args.beta1
+        )
+        trainer.train()
+        early_exit_report(model, val_data, trainer.device, args.exit_thresholds, args.report_positions)
+        return
+
+    if args.teacher_model:
+        teacher_config = get_configuration(args.teacher_config)
+        assert teacher_config["model"]["n_positions"] >= config["model"]["n_positions"], \
+            "The teacher must cover at least the student's n_positions"
+
+        print("Loading teacher model.")
+        teacher = build_model(teacher_config, tokenizer)
+        teacher.load_state_dict(load_checkpoint(args.teacher_model, map_location="cpu"))
+
+        # Distill the teacher into the student and report latency vs. agreement
+        trainer = DistillationTrainer(
+            model=model,
+            teacher=teacher,
+            train_loader=train_loader,
+            val_loader=val_loader,
+            loss_fn=loss_fn,
+            save_dir=args.save_dir,
+            learning_rate=args.lr,
+            num_epochs=args.epochs,
+            adam_beta=args.beta1,
+            temperature=args.distill_temperature,
+            alpha=args.distill_alpha,
+        )
+        trainer.train()
+        write_distillation_report(
+            trainer.report(args.report_batches),
+            os.path.join(args.save_dir, "distillation_report.tsv"),
+        )
+        return
+
     # Initialize and run the trainer
     trainer = Trainer(
         model=model,
@@ -196,7 +842,8 @@ def main(args) -> None:
         save_dir=args.save_dir,
         learning_rate=args.lr,
         num_epochs=args.epochs,
-        adam_beta=args.beta1
+        adam_beta=args.beta1,
+        loss_chunk_size=args.loss_chunk_size
     )
     trainer.train()
 
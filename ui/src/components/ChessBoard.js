@@ -1,5 +1,5 @@
 import "./ChessBoard.css";
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import axios from "axios";
 import Chess from "chess.js";
 import { Chessboard } from "react-chessboard";
@@ -11,6 +11,37 @@ export default function ChessBoard() {
   const [isLoading, setIsLoading] = useState(false);
   const [winner, setWinner] = useState(null);
 
+  // Whether the current game is already in the server's game store
+  const recorded = useRef(false);
+  const latestGame = useRef(game);
+  latestGame.current = game;
+
+  // Lets the server ponder on the human's likely replies to this game while they think
+  const sessionId = useRef(newSessionId());
+
+  function newSessionId() {
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+  }
+
+  function parseMoves(pgn) {
+    return pgn.replace(new RegExp(/\d+\. /, "g"), "");
+  }
+
+  function recordGame() {
+    const moves = parseMoves(latestGame.current.pgn());
+    if (recorded.current || !moves) return;
+    recorded.current = true;
+
+    // sendBeacon also delivers when the page is closing
+    navigator.sendBeacon(Constants.backend_url + "/games", JSON.stringify({ moves: moves }));
+  }
+
+  // Abandoned games are recorded when the page closes
+  useEffect(() => {
+    window.addEventListener("pagehide", recordGame);
+    return () => window.removeEventListener("pagehide", recordGame);
+  }, []);
+
   function safeGameMutate(modify) {
     setGame((g) => {
       const update = Object.assign(Object.create(Object.getPrototypeOf(g)), g);
@@ -24,6 +55,9 @@ export default function ChessBoard() {
       const winnerColor = game.turn() === "w" ? "Black" : "White";
       setWinner(`${winnerColor} Wins!`);
     }
+    if (game.game_over()) {
+      recordGame();
+    }
   }
 
   async function makeEngineMove(moves) {
@@ -33,11 +67,20 @@ export default function ChessBoard() {
 
     let response;
     let url = Constants.backend_url + "/predict";
-    let parsedMoves = moves.replace(new RegExp(/\d+\. /, "g"), "");
+    let parsedMoves = parseMoves(moves);
 
     try {
-      const res = await axios.post(url, { input_moves: parsedMoves });
+      const res = await axios.post(url, {
+        input_moves: parsedMoves,
+        session_id: sessionId.current,
+        ponder: true,
+      });
       response = res.data.moves;
+
+      // The server already records games the engine ends (checkmate or surrender)
+      if (typeof response === "string" && response.endsWith("<eos>")) {
+        recorded.current = true;
+      }
     } catch (error) {
       console.error("Engine move error:", error);
       response = {
@@ -77,6 +120,7 @@ export default function ChessBoard() {
 
   function undoLastMove() {
     setWinner(null);
+    recorded.current = false;
     safeGameMutate((game) => {
       game.undo();
       game.undo();
@@ -84,6 +128,9 @@ export default function ChessBoard() {
   }
 
   function resetBoard() {
+    recordGame();
+    recorded.current = false;
+    sessionId.current = newSessionId();
     setWinner(null);
     safeGameMutate((game) => {
       game.reset();